@@ -0,0 +1,292 @@
+"""
+Local archive of the consensuses and votes we've downloaded, so we can look
+back at what the authorities published.
+
+Documents are compressed individually and appended to a single file, with
+identical documents (such as the same consensus served by several
+authorities) only stored once. An index of...
+
+  (authority, document type, valid-after) => (digest, offset, length, codec)
+
+... lets us read any single document by decompressing just its portion of a
+memory-mapped archive file.
+
+Each DocumentArchive only reads the index when it's constructed, so writers
+must hold the archive's lock from opening it until it's closed...
+
+  with archive.lock(path):
+    document_archive = archive.DocumentArchive(path)
+    ... add and prune documents...
+    document_archive.close()
+"""
+
+import collections
+import datetime
+import hashlib
+import lzma
+import mmap
+import os
+import time
+
+import util
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None  # optional, we fall back to lzma without it
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+COMPACTION_THRESHOLD = 0.25  # rewrite our archive when this ratio of it is unreferenced
+
+ArchiveEntry = collections.namedtuple('ArchiveEntry', ['authority', 'document_type', 'valid_after', 'digest'])
+Frame = collections.namedtuple('Frame', ['offset', 'length', 'codec'])
+
+log = util.get_logger('archive')
+
+
+def lock(path):
+  """
+  Provides the lock writers of an archive hold.
+
+  :param str path: directory of the archive
+
+  :returns: **util.FileLock** for the archive
+  """
+
+  return util.FileLock(os.path.join(path, 'lock'))
+
+
+class DocumentArchive(object):
+  """
+  Archive of network status documents within a directory.
+
+  :var str path: directory of our archive
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._blob_name = 'documents-%i' % int(time.time())
+    self._entries = {}  # {(authority, document type, valid_after) => digest}
+    self._frames = {}  # {digest => Frame}
+    self._mmap = None
+    self._mmap_size = 0
+
+    if not os.path.exists(path):
+      os.makedirs(path)
+
+    index_path = os.path.join(path, 'index')
+
+    if os.path.exists(index_path):
+      with open(index_path) as index_file:
+        for line in index_file:
+          entry = line.split()
+
+          if len(entry) == 2 and entry[0] == 'blob':
+            self._blob_name = entry[1]
+          elif len(entry) == 8 and entry[0] == 'entry':
+            _, authority, document_type, valid_after, digest, offset, length, codec = entry
+            self._entries[(authority, document_type, datetime.datetime.strptime(valid_after, DATE_FORMAT))] = digest
+            self._frames[digest] = Frame(int(offset), int(length), codec)
+          elif entry:
+            log.debug("Skipping malformed archive index line: %s" % line.strip())
+    else:
+      util.atomic_write(index_path, 'blob %s\n' % self._blob_name)
+
+  def add(self, authority, document_type, valid_after, content):
+    """
+    Stores a document if we don't already have it.
+
+    :param str authority: nickname of the authority we got this from
+    :param str document_type: kind of document, such as 'consensus' or 'vote'
+    :param datetime valid_after: time the document became valid
+    :param bytes content: raw document content
+
+    :returns: **True** if this document was new to us, **False** otherwise
+    """
+
+    key = (authority, document_type, valid_after)
+
+    if key in self._entries:
+      return False
+
+    digest = hashlib.sha256(content).hexdigest()
+    frame = self._frames.get(digest)
+
+    if frame is None:
+      codec, compressed = _compress(content)
+
+      with open(self._blob_path(), 'ab') as blob_file:
+        blob_file.seek(0, os.SEEK_END)
+        frame = Frame(blob_file.tell(), len(compressed), codec)
+        blob_file.write(compressed)
+
+      self._frames[digest] = frame
+
+    with open(os.path.join(self.path, 'index'), 'a') as index_file:
+      index_file.write(_index_line(key, digest, frame))
+
+    self._entries[key] = digest
+    return True
+
+  def get(self, authority, document_type, valid_after):
+    """
+    Provides an archived document.
+
+    :param str authority: nickname of the authority we got this from
+    :param str document_type: kind of document, such as 'consensus' or 'vote'
+    :param datetime valid_after: time the document became valid
+
+    :returns: **bytes** of the document, **None** if we don't have it
+    """
+
+    digest = self._entries.get((authority, document_type, valid_after))
+
+    if digest is None:
+      return None
+
+    frame = self._frames[digest]
+
+    if self._mmap is None or frame.offset + frame.length > self._mmap_size:
+      self._open_mmap()
+
+    return _decompress(frame.codec, self._mmap[frame.offset:frame.offset + frame.length])
+
+  def entries(self, document_type = None, authority = None, since = None, until = None):
+    """
+    Provides the documents within our archive, sorted by their valid-after
+    time.
+
+    :param str document_type: only provide documents of this type
+    :param str authority: only provide documents from this authority
+    :param datetime since: only provide documents valid at or after this
+    :param datetime until: only provide documents valid before this
+
+    :returns: **list** of **ArchiveEntry** matching our criteria
+    """
+
+    results = []
+
+    for (entry_authority, entry_type, valid_after), digest in self._entries.items():
+      if document_type and entry_type != document_type:
+        continue
+      elif authority and entry_authority != authority:
+        continue
+      elif since and valid_after < since:
+        continue
+      elif until and valid_after >= until:
+        continue
+
+      results.append(ArchiveEntry(entry_authority, entry_type, valid_after, digest))
+
+    return sorted(results, key = lambda entry: (entry.valid_after, entry.document_type, entry.authority))
+
+  def prune(self, retention):
+    """
+    Drops documents that became valid more than the given number of days ago.
+    The archive file is rewritten once enough of it is unreferenced.
+
+    :param int retention: days we keep documents for
+    """
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days = retention)
+    expired = [key for key in self._entries if key[2] < cutoff]
+
+    if not expired:
+      return
+
+    for key in expired:
+      del self._entries[key]
+
+    referenced = set(self._entries.values())
+
+    for digest in list(self._frames):
+      if digest not in referenced:
+        del self._frames[digest]
+
+    blob_size = os.path.getsize(self._blob_path()) if os.path.exists(self._blob_path()) else 0
+    referenced_size = sum([frame.length for frame in self._frames.values()])
+
+    log.debug("Pruned %i archived documents older than %i days" % (len(expired), retention))
+
+    if blob_size and float(blob_size - referenced_size) / blob_size >= COMPACTION_THRESHOLD:
+      self._compact()
+    else:
+      self._write_index()
+
+  def close(self):
+    if self._mmap is not None:
+      self._mmap.close()
+      self._mmap = None
+
+  def _compact(self):
+    """
+    Copies our referenced frames to a new archive file. The index names the
+    file it refers to, so until the new index is in place readers continue to
+    use the old file.
+    """
+
+    old_blob_path = self._blob_path()
+    self._blob_name = 'documents-%i' % int(time.time())
+
+    if self._blob_path() == old_blob_path:
+      self._blob_name += '-1'
+
+    self._open_mmap(old_blob_path)
+    frames = {}
+
+    with open(self._blob_path(), 'wb') as blob_file:
+      for digest, frame in sorted(self._frames.items(), key = lambda item: item[1].offset):
+        frames[digest] = Frame(blob_file.tell(), frame.length, frame.codec)
+        blob_file.write(self._mmap[frame.offset:frame.offset + frame.length])
+
+    self.close()
+    self._frames = frames
+    self._write_index()
+    os.remove(old_blob_path)
+
+    log.debug("Compacted our archive to %i documents" % len(frames))
+
+  def _write_index(self):
+    lines = ['blob %s\n' % self._blob_name]
+
+    for key, digest in sorted(self._entries.items(), key = lambda item: item[0][2]):
+      lines.append(_index_line(key, digest, self._frames[digest]))
+
+    util.atomic_write(os.path.join(self.path, 'index'), ''.join(lines))
+
+  def _open_mmap(self, path = None):
+    self.close()
+
+    with open(path or self._blob_path(), 'rb') as blob_file:
+      self._mmap_size = os.fstat(blob_file.fileno()).st_size
+      self._mmap = mmap.mmap(blob_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+  def _blob_path(self):
+    return os.path.join(self.path, self._blob_name)
+
+  def __len__(self):
+    return len(self._entries)
+
+
+def _index_line(key, digest, frame):
+  authority, document_type, valid_after = key
+  return 'entry %s %s %s %s %i %i %s\n' % (authority, document_type, valid_after.strftime(DATE_FORMAT), digest, frame.offset, frame.length, frame.codec)
+
+
+def _compress(content):
+  if zstandard:
+    return 'zstd', zstandard.ZstdCompressor(level = 10).compress(content)
+  else:
+    return 'xz', lzma.compress(content, preset = 3)
+
+
+def _decompress(codec, content):
+  if codec == 'zstd':
+    if not zstandard:
+      raise IOError('Archived document is zstd compressed but the zstandard module is unavailable')
+
+    return zstandard.ZstdDecompressor().decompress(content)
+  elif codec == 'xz':
+    return lzma.decompress(content)
+  else:
+    raise IOError("Archived document has an unrecognized codec: %s" % codec)
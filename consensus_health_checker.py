@@ -4,28 +4,41 @@
 
 """
 Performs a variety of checks against the present votes and consensus.
+
+Checks can also be replayed against archived documents, to see what they would
+have reported during past hours...
+
+  % python consensus_health_checker.py --replay data/archive
 """
 
 import collections
 import datetime
+import functools
 import os
+import statistics
+import string
 import time
 import traceback
 
+import archive
+import flag_trends
 import util
 
-import stem.descriptor
-import stem.descriptor.remote
-import stem.directory
 import stem.util.conf
 import stem.util.enum
 
 from stem import Flag
-from stem.util.lru_cache import lru_cache
 
 Runlevel = stem.util.enum.UppercaseEnum('NOTICE', 'WARNING', 'ERROR')
+CheckKind = stem.util.enum.UppercaseEnum('IO', 'CPU')
+
+# Authority lookups, populated by load_authorities(). These and the heavier
+# modules of stem aren't loaded until we need them, so runs that exit early
+# start quickly.
 
-DIRECTORY_AUTHORITIES = stem.directory.Authority.from_cache()
+DIRECTORY_AUTHORITIES = {}  # {nickname => authority}
+AUTHORITIES_BY_V3IDENT = {}  # {v3ident => authority}
+AUTHORITIES_BY_FINGERPRINT = {}  # {fingerprint => authority}
 
 DIRAUTH_SKIP_CHECKS = (
   'tor26',   # tor26 DirPort does not service requests without a .z suffix
@@ -33,41 +46,181 @@ DIRAUTH_SKIP_CHECKS = (
 )
 
 EMAIL_SUBJECT = 'Consensus issues'
+AGGREGATION_THRESHOLD = 3  # similar issues we'll list before summarizing them
+CHECK_TIMEOUT = 300  # seconds our checks have to finish
+CERTIFICATE_RETENTION = datetime.timedelta(days = 30)  # how long we remember expired key certificates
+REPLAY_DELAY = datetime.timedelta(minutes = 10)  # when in the hour replayed checks are considered to run
+MAX_SUPPRESSION = 14 * 24  # hours of our longest suppression, for pruning old entries
 BANDWIDTH_AUTHORITIES = ('moria1', 'gabelmoo', 'maatuska', 'Faravahar', 'bastet', 'longclaw')
+BANDWIDTH_DRIFT = 1.5  # factor a scanner's median ratio to consensus weight can differ from the others
+BANDWIDTH_DISAGREEMENT = 10  # factor a relay's measurements can differ between scanners
+MAX_DISAGREEING_RELAYS = 100  # relays with disagreeing measurements before we notify
 
 CONFIG = stem.util.conf.config_dict('consensus_health', {
   'msg': {},
+  'mask': {},
+  'aggregate': {},
   'suppression': {},
   'known_params': [],
   'contact_address': {},
   'contact_via_bcc': [],
+  'archive_retention': 30,
 })
 
 log = util.get_logger('consensus_health_checker')
-util.log_stem_debugging('consensus_health_checker')
 
-downloader = stem.descriptor.remote.DescriptorDownloader(
-  timeout = 60,
-  fall_back_to_authority = False,
-  document_handler = stem.descriptor.DocumentHandler.DOCUMENT,
-)
+downloader = None  # constructed on first use by get_downloader()
 
 Destination = collections.namedtuple('Destination', ('address', 'bcc'))
+Check = collections.namedtuple('Check', ('function', 'kind', 'inputs'))
+
+TEMPLATES = {}  # mapping of template names to their IssueTemplate
+CHECK_INPUTS = None  # documents our checks run against, shared with forked processes
+KEY_CERTIFICATES = {}  # {v3ident => expiration of their latest key certificate}
+FIXED_TIME = None  # time our checks consider to be 'now' when replaying documents
+
+
+class IssueTemplate(object):
+  """
+  Message template for a kind of issue, compiled from our configuration so
+  issues can be rendered without consulting it.
+
+  :var str name: name of the template
+  :var str message: format string for the issue's description
+  :var str key_format: format string for the issue's suppression key, with
+    masked attributes already filled in
+  :var int suppression_duration: hours this issue is suppressed after being
+    shown, **None** if this should be based on the runlevel
+  :var tuple aggregate_by: attributes similar issues are grouped by, **None**
+    if these issues aren't aggregated
+  """
+
+  __slots__ = ('name', 'message', 'key_format', 'suppression_duration', 'aggregate_by')
+
+  def __init__(self, name, message, mask = None, suppression_duration = None, aggregate_by = None):
+    self.name = name
+    self.message = message
+    self.key_format = message
+    self.suppression_duration = None
+    self.aggregate_by = tuple([attr.strip() for attr in aggregate_by.split(',') if attr.strip()]) if aggregate_by is not None else None
+
+    if mask:
+      # Substitute masked fields into the template. Their replacements are
+      # escaped since the result is itself a format string.
+
+      masked_values = {}
+
+      for entry in mask.split(','):
+        field, value = entry.split('=', 1) if '=' in entry else (entry, '')
+        value = value.strip()
+        masked_values[field.strip()] = int(value) if value.isdigit() else value
+
+      key_format = ''
+
+      for literal, field, spec, conversion in string.Formatter().parse(message):
+        key_format += literal.replace('{', '{{').replace('}', '}}')
+
+        if field is None:
+          continue
+        elif field in masked_values:
+          key_format += format(masked_values[field], spec or '').replace('{', '{{').replace('}', '}}')
+        else:
+          key_format += '{%s%s%s}' % (field, '!' + conversion if conversion else '', ':' + spec if spec else '')
+
+      self.key_format = key_format
+
+    if suppression_duration is not None:
+      try:
+        self.suppression_duration = int(suppression_duration)
+      except ValueError:
+        log.error("Non-numic suppression time (%s): %s" % (name, suppression_duration))
+
+  def format_message(self, attr):
+    """
+    Provides the description of an issue with the given attributes.
+
+    :param dict attr: attributes of the issue
+
+    :returns: **str** with a description of the issue
+    """
+
+    try:
+      return self.message.format(**attr)
+    except:
+      log.error("Unable to apply formatted string attributes to msg.%s: %s" % (self.name, attr))
+      return ''
+
+  def format_suppression_key(self, attr):
+    """
+    Provides the key used to suppress an issue with the given attributes.
+
+    :param dict attr: attributes of the issue
+
+    :returns: **str** used for the suppression of the issue
+    """
+
+    try:
+      return self.key_format.format(**attr).replace(' ', '_')
+    except:
+      return ''
+
+
+def compile_templates():
+  """
+  Compiles our configured messages into IssueTemplates. This should be called
+  after our configuration is loaded.
+  """
+
+  TEMPLATES.clear()
+
+  for name in CONFIG['msg']:
+    _get_template(name)
+
+
+def _get_template(name):
+  template = TEMPLATES.get(name)
+
+  if template is None:
+    if name not in CONFIG['msg']:
+      log.error("Missing configuration value: msg.%s" % name)
+
+    template = IssueTemplate(name, CONFIG['msg'].get(name, ''), CONFIG['mask'].get(name), CONFIG['suppression'].get(name), CONFIG['aggregate'].get(name))
+    TEMPLATES[name] = template
+
+  return template
 
 
 class Issue(object):
   """
-  Problem to be reported at the end of the run.
+  Problem to be reported at the end of the run. Its message and suppression
+  key are rendered when it's created.
   """
 
+  __slots__ = ('_runlevel', '_template', '_authorities', '_message', '_suppression_key', '_suppression_duration', '_group', '_group_key')
+
   def __init__(self, runlevel, template, **attr):
+    compiled = _get_template(template)
+    authorities = attr.get('to', [])
+
     self._runlevel = runlevel
     self._template = template
-    self._attr = attr
-
-    self._authorities = attr.get('to', [])
+    self._authorities = [authorities] if isinstance(authorities, str) else list(authorities)
+    self._message = compiled.format_message(attr)
+    self._suppression_key = compiled.format_suppression_key(attr)
+    self._suppression_duration = compiled.suppression_duration
+    self._group = (template,) + tuple([str(attr.get(key)) for key in compiled.aggregate_by]) if compiled.aggregate_by is not None else None
+    self._group_key = '%s(%s)' % (self._group[0], ','.join(self._group[1:]).replace(' ', '_')) if self._group else None
+
+    if self._suppression_duration is None:
+      # Default to suppression based on the severity of the issue.
+
+      if runlevel == Runlevel.NOTICE:
+        self._suppression_duration = 24  # 1 day
+      elif runlevel == Runlevel.WARNING:
+        self._suppression_duration = 4  # 4 hours
+      else:
+        self._suppression_duration = 0  # no suppression for errors
 
-  @lru_cache()
   def get_message(self):
     """
     Provides the description of the problem.
@@ -75,15 +228,7 @@ class Issue(object):
     :returns: **str** with a description of the issue
     """
 
-    if self._template in CONFIG['msg']:
-      try:
-        return CONFIG['msg'][self._template].format(**self._attr)
-      except:
-        log.error("Unable to apply formatted string attributes to msg.%s: %s" % (self._template, self._attr))
-    else:
-      log.error("Missing configuration value: msg.%s" % self._template)
-
-    return ''
+    return self._message
 
   def get_runlevel(self):
     """
@@ -94,7 +239,6 @@ class Issue(object):
 
     return self._runlevel
 
-  @lru_cache()
   def get_destinations(self):
     """
     Provides a mapping of authorities with this issue to their Destination. The
@@ -116,7 +260,6 @@ class Issue(object):
 
     return destinations
 
-  @lru_cache()
   def get_suppression_key(self):
     """
     Provides the key used for issue suppression.
@@ -125,39 +268,34 @@ class Issue(object):
       suppressions file
     """
 
-    if self._template == 'TOO_MANY_UNMEASURED_RELAYS':
-      # Hack because this message has too much dynamic data to be effectively
-      # suppressed. Hate doing this here, so better would be to make this a
-      # config property.
+    return self._suppression_key
+
+  def get_suppression_keys(self):
+    """
+    Provides the keys we mark as suppressed when notifying for this issue.
+
+    :returns: **list** of **str** suppression keys
+    """
 
-      attr = dict(self._attr)
-      attr.update({'unmeasured': 0, 'total': 0, 'percentage': 0})
+    return [self._suppression_key]
 
-      return CONFIG['msg'][self._template].format(**attr).replace(' ', '_')
-    elif self._template == 'BANDWIDTH_AUTHORITIES_OUT_OF_SYNC':
-      attr = dict(self._attr)
-      attr.update({'authorities': ''})
+  def get_suppression_alternatives(self):
+    """
+    Provides the sets of keys that each suppress this issue if all of their
+    keys are suppressed. An aggregated issue is also suppressed if we recently
+    notified for its group, so it isn't repeated when the number of similar
+    issues falls below our AGGREGATION_THRESHOLD.
 
-      return CONFIG['msg'][self._template].format(**attr).replace(' ', '_')
-    elif self._template == 'LATENCY':
-      attr = dict(self._attr)
-      attr.update({'authority': '', 'time_taken': '', 'median_time': '', 'authority_times': ''})
+    :returns: **list** of **list** with **str** suppression keys
+    """
 
-      return CONFIG['msg'][self._template].format(**attr).replace(' ', '_')
-    elif self._template == 'CLOCK_SKEW':
-      attr = dict(self._attr)
-      attr.update({'authority': '', 'difference': ''})
+    alternatives = [[self._suppression_key]]
 
-      return CONFIG['msg'][self._template].format(**attr).replace(' ', '_')
-    elif self._template == 'FLAG_COUNT_DIFFERS':
-      attr = dict(self._attr)
-      attr.update({'consensus_count': 0, 'vote_count': 0})
+    if self._group_key:
+      alternatives.append([self._group_key])
 
-      return CONFIG['msg'][self._template].format(**attr).replace(' ', '_')
-    else:
-      return self.get_message().replace(' ', '_')
+    return alternatives
 
-  @lru_cache()
   def get_suppression_duration(self):
     """
     Provides the number of hours we should suppress this message after it has
@@ -167,32 +305,89 @@ class Issue(object):
       after its been shown
     """
 
-    if self._template in CONFIG['suppression']:
-      suppression_duration = CONFIG['suppression'][self._template]
+    return self._suppression_duration
 
-      try:
-        return int(suppression_duration)
-      except ValueError:
-        log.error("Non-numic suppression time (%s): %s" % (self._template, suppression_duration))
+  def __str__(self):
+    return "%s: %s" % (self.get_runlevel(), self.get_message())
+
+
+class IssueGroup(Issue):
+  """
+  Summary of several similar issues, reported in place of them. This lists a
+  few as examples and is suppressed as a whole. Its members are suppressed
+  too, and it's suppressed if they all are, so the issues aren't repeated if
+  their number crosses our AGGREGATION_THRESHOLD between runs.
+  """
+
+  __slots__ = ('_count', '_member_keys')
+
+  def __init__(self, issues):
+    self._runlevel = max([issue.get_runlevel() for issue in issues], key = Runlevel.index_of)
+    self._template = issues[0]._template
+    self._authorities = []
+    self._count = len(issues)
+    self._group = issues[0]._group
+    self._group_key = issues[0]._group_key
+    self._suppression_key = self._group_key
+    self._member_keys = sorted(set([issue.get_suppression_key() for issue in issues]))
+    self._suppression_duration = min([issue.get_suppression_duration() for issue in issues])
+
+    for issue in issues:
+      self._authorities += [authority for authority in issue._authorities if authority not in self._authorities]
+
+    exemplars = [issue.get_message() for issue in issues[:AGGREGATION_THRESHOLD]]
+    self._message = '%s (and %i more like this)' % ('; '.join(exemplars), self._count - len(exemplars))
+
+  def get_count(self):
+    """
+    Provides the number of issues we're summarizing.
+
+    :returns: **int** for the number of issues in this group
+    """
+
+    return self._count
+
+  def get_suppression_keys(self):
+    return [self._suppression_key] + self._member_keys
 
-    # Default to suppression based on the severity of the issue.
+  def get_suppression_alternatives(self):
+    return [[self._suppression_key], self._member_keys]
 
-    if self.get_runlevel() == Runlevel.NOTICE:
-      return 24  # 1 day
-    elif self.get_runlevel() == Runlevel.WARNING:
-      return 4  # 4 hours
+
+def aggregate_issues(issues):
+  """
+  Summarizes groups of similar issues so a bad hour doesn't produce hundreds
+  of notices. Issues are grouped by their template's aggregation attributes,
+  and groups with more than a few issues are collapsed into an IssueGroup.
+
+  :param list issues: issues to aggregate
+
+  :returns: **list** of issues with large groups replaced by an IssueGroup
+  """
+
+  groups = collections.OrderedDict()  # {group => [issues]}
+
+  for issue in issues:
+    groups.setdefault(issue._group or id(issue), []).append(issue)
+
+  results = []
+
+  for group, members in groups.items():
+    if len(members) > AGGREGATION_THRESHOLD:
+      log.debug("Summarizing %i %s issues" % (len(members), members[0]._template))
+      results.append(IssueGroup(members))
     else:
-      return 0  # no suppression for errors
+      results += members
 
-  def __str__(self):
-    return "%s: %s" % (self.get_runlevel(), self.get_message())
+  return results
 
 
-def is_rate_limited(issue):
+def is_rate_limited(issue, suppressions):
   """
   Check if we have sent a notice with this key within a given period of time.
 
   :param Issue issue: issue to check the suppression status for
+  :param util.SuppressionStore suppressions: when we last notified for issues
   """
 
   key = issue.get_suppression_key()
@@ -201,11 +396,10 @@ def is_rate_limited(issue):
   if hours == 0:
     return False
 
-  current_time = int(time.time())
-  last_seen = stem.util.conf.get_config('last_notified').get(key, 0)
-  suppression_time = 3600 * hours
-  suppression_time += 1800  # adding a half hour so timing doesn't coinside with our hourly cron
-  suppression_time_remaining = suppression_time - (current_time - last_seen)
+  # suppressed for as long as any of its alternatives has all of its keys suppressed
+
+  seconds = _suppression_seconds(hours)
+  suppression_time_remaining = max([min([suppressions.remaining(alt_key, seconds) for alt_key in keys]) for keys in issue.get_suppression_alternatives()])
 
   if suppression_time_remaining <= 0:
     return False
@@ -214,59 +408,65 @@ def is_rate_limited(issue):
     return True
 
 
-def rate_limit_notice(issue):
+def rate_limit_notice(issue, suppressions):
   """
   Record that this notice is being sent, so further runs will take this into
-  account for rate limitation.
+  account for rate limitation. This isn't persisted until the suppressions
+  are committed.
 
   :param Issue issue: issue to update the suppression status for
+  :param util.SuppressionStore suppressions: when we last notified for issues
   """
 
-  key = issue.get_suppression_key()
   hours = issue.get_suppression_duration()
 
   if hours == 0:
     return
 
-  config = stem.util.conf.get_config('last_notified')
-  config.set(key, str(int(time.time())), overwrite = True)
-  config.save()
+  for key in issue.get_suppression_keys():
+    suppressions.mark(key, _suppression_seconds(hours))
 
 
-def main():
-  start_time = time.time()
+def _suppression_seconds(hours):
+  # adding a half hour so timing doesn't coinside with our hourly cron
 
-  # loads configuration data
-
-  config = stem.util.conf.get_config("consensus_health")
-  config.load(util.get_path('data', 'consensus_health.cfg'))
+  return 3600 * hours + 1800
 
-  contact_path = util.get_path('data', 'contact_information.cfg')
 
-  if os.path.exists(contact_path):
-    config.load(contact_path)
+def main():
+  if not util.acquire_run_lock('consensus_health_checker'):
+    log.warn("Our previous run is still active. Skipping this one so we don't add to the load on the authorities.")
+    return
 
-  config = stem.util.conf.get_config('last_notified')
-  last_notified_path = util.get_path('data', 'last_notified.cfg')
+  util.log_stem_debugging('consensus_health_checker')
+  start_time = time.time()
+  load_config()
+  load_authorities()
 
-  if os.path.exists(last_notified_path):
-    config.load(last_notified_path)
-  else:
-    config._path = last_notified_path
+  suppressions = util.SuppressionStore('last_notified', default_duration = _suppression_seconds(MAX_SUPPRESSION))
 
   consensuses, consensus_fetching_issues = get_consensuses()
   votes, vote_fetching_issues = get_votes()
   issues = consensus_fetching_issues + vote_fetching_issues
 
+  archive_documents(consensuses, votes)
+  update_key_certificates(votes, util.get_path('data', 'key_certificates'))
+
   if consensuses and votes:
     issues += run_checks(consensuses, votes)
+
+    trends = flag_trends.FlagTrends(util.get_path('data', 'flag_trends'))
+    issues += check_flag_trends(votes, trends)
+    trends.save()
   else:
     log.warn("Unable to retrieve any votes. Skipping checks.")
 
+  issues = aggregate_issues(issues)
+
   is_all_suppressed = True  # either no issues or they're all already suppressed
 
   for issue in issues:
-    if not is_rate_limited(issue):
+    if not is_rate_limited(issue, suppressions):
       is_all_suppressed = False
       break
 
@@ -274,7 +474,7 @@ def main():
     destinations = {}
 
     for issue in issues:
-      rate_limit_notice(issue)
+      rate_limit_notice(issue, suppressions)
       destinations.update(issue.get_destinations())
 
     destination_labels = []
@@ -305,20 +505,345 @@ def main():
     else:
       log.info("No issues found.")
 
+  suppressions.commit()
   log.debug("Checks finished, runtime was %0.2f seconds" % (time.time() - start_time))
 
 
-def run_checks(consensuses, votes):
+def load_config():
+  """
+  Loads our configuration data and compiles our message templates.
+  """
+
+  config = stem.util.conf.get_config("consensus_health")
+  config.load(util.get_path('data', 'consensus_health.cfg'))
+
+  contact_path = util.get_path('data', 'contact_information.cfg')
+
+  if os.path.exists(contact_path):
+    config.load(contact_path)
+
+  compile_templates()
+
+
+def load_authorities():
+  """
+  Populates our lookups of the directory authorities if we haven't already.
+  """
+
+  if DIRECTORY_AUTHORITIES:
+    return
+
+  import stem.directory
+
+  for authority in stem.directory.Authority.from_cache().values():
+    DIRECTORY_AUTHORITIES[authority.nickname] = authority
+    AUTHORITIES_BY_FINGERPRINT[authority.fingerprint] = authority
+
+    if authority.v3ident:
+      AUTHORITIES_BY_V3IDENT[authority.v3ident] = authority
+
+
+def get_downloader():
+  """
+  Provides the downloader we fetch documents with, constructing it on first
+  use.
+
+  :returns: **stem.descriptor.remote.DescriptorDownloader** for our queries
+  """
+
+  global downloader
+
+  if downloader is None:
+    import stem.descriptor
+    import stem.descriptor.remote
+
+    downloader = stem.descriptor.remote.DescriptorDownloader(
+      timeout = 60,
+      fall_back_to_authority = False,
+      document_handler = stem.descriptor.DocumentHandler.DOCUMENT,
+    )
+
+  return downloader
+
+
+def replay(path, since = None, until = None):
+  """
+  Runs our checks against previously recorded consensuses and votes, printing
+  the issues we would have reported for each hour. Network checks are skipped
+  and the clock is fixed to shortly after each hour's valid-after time.
+
+  :param str path: our archive directory, or a directory of consensus and
+    vote files (such as those from CollecTor)
+  :param datetime since: only replay hours at or after this
+  :param datetime until: only replay hours before this
+  """
+
+  global FIXED_TIME, KEY_CERTIFICATES
+
+  load_config()
+  load_authorities()
+  KEY_CERTIFICATES = {}  # only learned from replayed votes
+  hours, total_issues, start_time = 0, 0, time.time()
+  trends = flag_trends.FlagTrends()  # only kept in memory while replaying
+
+  for valid_after, consensuses, votes in _replay_documents(path, since, until):
+    hour_start = time.time()
+    FIXED_TIME = valid_after + REPLAY_DELAY
+    update_key_certificates(votes)
+
+    try:
+      issues = aggregate_issues(run_checks(consensuses, votes, include_io = False) + check_flag_trends(votes, trends))
+    except Exception as exc:
+      print('%s: unable to run our checks (%s)' % (valid_after, exc))
+      continue
+    finally:
+      FIXED_TIME = None
+
+    hours += 1
+    total_issues += len(issues)
+
+    print('%s (%i consensuses, %i votes, %i issues, %0.2fs)' % (valid_after, len(consensuses), len(votes), len(issues), time.time() - hour_start))
+
+    for issue in issues:
+      print('  %s' % issue)
+
+  print('Replayed %i hours with %i issues in %0.2fs' % (hours, total_issues, time.time() - start_time))
+
+
+def _replay_documents(path, since, until):
+  """
+  Provides the documents we're replaying, an hour at a time. Documents are
+  only parsed when their hour is reached.
+
+  :returns: iterator of (valid_after, consensuses, votes) tuples
+  """
+
+  import stem.descriptor.networkstatus
+
+  hours = {}  # {valid_after => [(document type, authority, loader)]}
+
+  if os.path.exists(os.path.join(path, 'index')):
+    document_archive = archive.DocumentArchive(path)
+
+    for entry in document_archive.entries(since = since, until = until):
+      loader = functools.partial(document_archive.get, entry.authority, entry.document_type, entry.valid_after)
+      hours.setdefault(entry.valid_after, []).append((entry.document_type, entry.authority, loader))
+  else:
+    for root, _, filenames in os.walk(path):
+      for filename in filenames:
+        file_path = os.path.join(root, filename)
+
+        with open(file_path, 'rb') as document_file:
+          document_type, authority, valid_after = _document_header(document_file)
+
+        if not valid_after:
+          log.debug("Skipping %s, it isn't a consensus or vote" % file_path)
+        elif (since and valid_after < since) or (until and valid_after >= until):
+          continue
+        else:
+          hours.setdefault(valid_after, []).append((document_type, authority or filename, functools.partial(_read_file, file_path)))
+
+  for valid_after in sorted(hours):
+    consensuses, votes = {}, {}
+
+    for document_type, authority, loader in hours[valid_after]:
+      content = loader()
+
+      if content.startswith(b'@type'):
+        content = content.split(b'\n', 1)[1]  # drop CollecTor's annotation
+
+      document = stem.descriptor.networkstatus.NetworkStatusDocumentV3(content)
+
+      if document_type == 'vote':
+        if authority not in DIRECTORY_AUTHORITIES:
+          log.debug("Skipping %s's vote, they're not a present authority" % authority)
+          continue
+
+        votes[authority] = document
+      else:
+        consensuses[authority] = document
+
+    yield valid_after, consensuses, votes
+
+
+def _document_header(document_file):
+  """
+  Reads just enough of a document to tell what it is.
+
+  :returns: tuple of the form (document type, authority, valid_after), with
+    valid_after being **None** if this isn't a network status document
+  """
+
+  document_type, authority, valid_after = 'consensus', None, None
+
+  for line in document_file:
+    keyword, _, value = line.decode('utf-8', 'replace').strip().partition(' ')
+
+    if keyword == 'vote-status':
+      document_type = 'vote' if value == 'vote' else 'consensus'
+    elif keyword == 'valid-after':
+      valid_after = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    elif keyword == 'dir-source':
+      if document_type == 'vote':
+        authority = value.split(' ', 1)[0]
+
+      break  # header is done
+    elif keyword in ('r', 'directory-footer'):
+      break
+
+  return document_type, authority, valid_after
+
+
+def _read_file(path):
+  with open(path, 'rb') as document_file:
+    return document_file.read()
+
+
+def get_current_time():
+  """
+  Provides the time our checks should consider to be 'now'. This is the
+  present time unless we're replaying documents.
+
+  :returns: **datetime** for the current local time
+  """
+
+  return FIXED_TIME if FIXED_TIME else datetime.datetime.now()
+
+
+def get_current_utc_time():
+  """
+  Provides the time our checks should consider to be 'now' in UTC.
+
+  :returns: **datetime** for the current UTC time
+  """
+
+  return FIXED_TIME if FIXED_TIME else datetime.datetime.utcnow()
+
+
+def archive_documents(consensuses, votes):
+  """
+  Saves the documents we've downloaded to our local archive, and drops those
+  that are past our retention.
+
+  :param dict consensuses: mapping of authorities to their consensus
+  :param dict votes: mapping of authorities to their votes
+  """
+
+  archive_path = util.get_path('data', 'archive')
+
+  try:
+    with archive.lock(archive_path):
+      document_archive = archive.DocumentArchive(archive_path)
+
+      for document_type, documents in (('consensus', consensuses), ('vote', votes)):
+        for authority, document in documents.items():
+          document_archive.add(authority, document_type, document.valid_after, document.get_bytes())
+
+      document_archive.prune(CONFIG['archive_retention'])
+      document_archive.close()
+  except Exception as exc:
+    log.warn("Unable to archive our documents: %s" % exc)
+
+
+def update_key_certificates(votes, path = None):
+  """
+  Notes the key certificates of the authorities that voted. Certificates are
+  cached by their v3ident and expiration, so certificate_expiration() can
+  check the authorities we didn't get a vote from this hour too.
+
+  :param dict votes: mapping of authorities to their votes
+  :param str path: file our cache is persisted to, only kept in memory if
+    **None**
+  """
+
+  is_changed = False
+
+  if path and not KEY_CERTIFICATES and os.path.exists(path):
+    with open(path) as cache_file:
+      for line in cache_file:
+        entry = line.split()
+
+        if len(entry) == 2:
+          KEY_CERTIFICATES[entry[0]] = datetime.datetime.strptime(entry[1], '%Y-%m-%dT%H:%M:%S')
+        elif entry:
+          log.debug("Skipping malformed key certificate cache line: %s" % line.strip())
+
+  for vote in votes.values():
+    # votes should only have a single authority entry (the one that issued this vote)
+
+    certificate = vote.directory_authorities[0].key_certificate
+
+    if certificate and certificate.expires and certificate.expires > KEY_CERTIFICATES.get(certificate.fingerprint, datetime.datetime.min):
+      KEY_CERTIFICATES[certificate.fingerprint] = certificate.expires
+      is_changed = True
+
+  cutoff = get_current_utc_time() - CERTIFICATE_RETENTION
+
+  for v3ident, expires in list(KEY_CERTIFICATES.items()):
+    if expires < cutoff:
+      del KEY_CERTIFICATES[v3ident]
+      is_changed = True
+
+  if path and is_changed:
+    try:
+      util.atomic_write(path, ''.join(['%s %s\n' % (v3ident, expires.strftime('%Y-%m-%dT%H:%M:%S')) for v3ident, expires in sorted(KEY_CERTIFICATES.items())]))
+    except Exception as exc:
+      log.warn("Unable to save our key certificate cache: %s" % exc)
+
+
+def check_flag_trends(votes, trends):
+  """
+  Adds the flags assigned by each authority to our running statistics, and
+  reports sudden shifts from their usual counts. Unlike our other checks this
+  updates persistent state, so it isn't among our CHECKS.
+
+  :param dict votes: mapping of authorities to their votes
+  :param flag_trends.FlagTrends trends: statistics to check against
+
+  :returns: **list** of issues for flag counts that deviated from the norm
+  """
+
+  issues = []
+
+  for authority, vote in votes.items():
+    flag_counts = {}
+
+    for desc in vote.routers.values():
+      for flag in desc.flags:
+        flag_counts[flag] = flag_counts.get(flag, 0) + 1
+
+    for anomaly in trends.update(authority, vote.valid_after, flag_counts):
+      issues.append(Issue(Runlevel.NOTICE, 'FLAG_COUNT_TREND', authority = authority, flag = anomaly.flag, vote_count = anomaly.count, average = int(round(anomaly.mean)), zscore = '%+0.1f' % anomaly.zscore, to = [authority]))
+
+  if votes:
+    trends.prune(max([vote.valid_after for vote in votes.values()]))
+
+  return issues
+
+
+def run_checks(consensuses, votes, timeout = CHECK_TIMEOUT, include_io = True):
   """
   Performs our checks against the given consensus and vote documents. Checker
   functions are expected to be of the form...
 
     my_check(latest_consensus, consensuses, votes) => Issue or list of Issues
 
+  Checks are registered in CHECKS. Network bound (IO) checks run concurrently
+  on threads, while CPU bound checks run on a pool of forked processes that
+  share our documents. Checks that don't finish within our timeout are
+  reported as an issue.
+
   :param dict consensuses: mapping of authorities to their consensus
   :param dict votes: mapping of authorities to their votes
+  :param int timeout: seconds our checks have to finish
+  :param bool include_io: runs network bound checks if **True**
   """
 
+  global CHECK_INPUTS
+
+  import multiprocessing
+
+  load_authorities()
   latest_consensus, latest_valid_after = None, None
 
   for consensus in consensuses.values():
@@ -326,35 +851,69 @@ def run_checks(consensuses, votes):
       latest_consensus = consensus
       latest_valid_after = consensus.valid_after
 
-  checker_functions = (
-    missing_latest_consensus,
-    missing_authority_descriptor,
-    consensus_method_unsupported,
-    different_recommended_client_version,
-    different_recommended_server_version,
-    #unknown_consensus_parameters,  # tor is fiddling with these quite a bit, #24895
-    #vote_parameters_mismatch_consensus,
-    certificate_expiration,
-    consensuses_have_same_votes,
-    has_all_signatures,
-    voting_bandwidth_scanners,
-    #unmeasured_relays,
-    has_authority_flag,
-    has_similar_flag_counts,
-    is_recommended_versions,
-    bad_exits_in_sync,
-    bandwidth_authorities_in_sync,
-    is_orport_reachable,
-    shared_random_present,
-    shared_random_commit_partitioning,
-    shared_random_reveal_partitioning,
-    old_dizum_address_reachable,
-  )
+  inputs = {'consensus': latest_consensus, 'consensuses': consensuses, 'votes': votes}
+  checks = []
+
+  for check in CHECKS:
+    missing_inputs = [name for name in check.inputs if not inputs[name]]
+
+    if missing_inputs:
+      log.debug("Skipping %s, we lack its %s" % (check.function.__name__, ', '.join(missing_inputs)))
+    elif check.kind == CheckKind.IO and not include_io:
+      continue
+    else:
+      checks.append(check)
+
+  deadline = time.time() + timeout
+  CHECK_INPUTS = (latest_consensus, consensuses, votes)
+  results = {}  # {check name => (issues, exception)}
+
+  cpu_checks = [check.function.__name__ for check in checks if check.kind == CheckKind.CPU]
+  io_checks = [(check.function.__name__, functools.partial(check.function, *CHECK_INPUTS)) for check in checks if check.kind == CheckKind.IO]
+
+  try:
+    pool = multiprocessing.get_context('fork').Pool(min(len(cpu_checks), multiprocessing.cpu_count())) if cpu_checks else None
+  except (AttributeError, ValueError, OSError) as exc:
+    log.debug("Unable to run checks on a process pool, running them serially instead: %s" % exc)
+    pool = None
+
+  try:
+    if pool:
+      pending = [(name, pool.apply_async(_run_check, (name,))) for name in cpu_checks]
+    else:
+      pending = []
+
+      for name in cpu_checks:
+        results[name] = (_run_check(name), None)
+
+    results.update(util.run_in_threads(io_checks, max_workers = len(io_checks), timeout = timeout))
+
+    for name, async_result in pending:
+      try:
+        results[name] = (async_result.get(max(0, deadline - time.time())), None)
+      except multiprocessing.TimeoutError:
+        pass
+      except Exception as exc:
+        results[name] = (None, exc)
+  finally:
+    if pool:
+      pool.terminate()
+
+    CHECK_INPUTS = None
 
   all_issues = []
 
-  for checker in checker_functions:
-    issues = checker(latest_consensus, consensuses, votes)
+  for check in checks:
+    name = check.function.__name__
+
+    if name not in results:
+      log.warn("%s didn't finish within %i seconds" % (name, timeout))
+      issues = Issue(Runlevel.WARNING, 'CHECK_TIMED_OUT', check = name, timeout = timeout)
+    else:
+      issues, exc = results[name]
+
+      if exc:
+        raise exc
 
     if issues:
       if isinstance(issues, Issue):
@@ -367,11 +926,24 @@ def run_checks(consensuses, votes):
   return all_issues
 
 
+def _run_check(name):
+  """
+  Runs a check against our CHECK_INPUTS. This is done by name so it can be
+  dispatched to forked processes.
+  """
+
+  try:
+    return globals()[name](*CHECK_INPUTS)
+  except:
+    log.error("%s failed with:\n\n%s" % (name, traceback.format_exc()))
+    raise
+
+
 def missing_latest_consensus(latest_consensus, consensuses, votes):
   "Checks that none of the consensuses are more than an hour old."
 
   stale_authorities = []
-  current_time = datetime.datetime.now()
+  current_time = get_current_time()
 
   for authority, consensus in consensuses.items():
     if (current_time - consensus.valid_after) > datetime.timedelta(hours = 1):
@@ -509,12 +1081,18 @@ def certificate_expiration(latest_consensus, consensuses, votes):
   "Check if an authority's certificate is about to expire."
 
   issues = []
-  current_time = datetime.datetime.now()
+  current_time = get_current_time()
 
   for authority, vote in votes.items():
-    # votes should only have a single authority entry (the one that issued this vote)
+    # Only authorities that voted this round are checked, with the newest
+    # certificate we know of. Our cache remembers certificates for a while
+    # after they expire, but those are no longer about to.
+
+    cert_expiration = KEY_CERTIFICATES.get(vote.directory_authorities[0].v3ident)
+
+    if cert_expiration is None or cert_expiration <= current_time:
+      continue
 
-    cert_expiration = vote.directory_authorities[0].key_certificate.expires
     expiration_label = '%s (%s)' % (authority, cert_expiration.strftime('%Y-%m-%d %H-%M-%S'))
 
     if (cert_expiration - current_time) <= datetime.timedelta(days = 7):
@@ -530,7 +1108,7 @@ def certificate_expiration(latest_consensus, consensuses, votes):
 def consensuses_have_same_votes(latest_consensus, consensuses, votes):
   "Checks that all fresh consensuses are made up of the same votes."
 
-  current_time = datetime.datetime.now()
+  current_time = get_current_time()
   fresh_consensuses = dict((k, v) for k, v in consensuses.items() if ((current_time - v.valid_after) < datetime.timedelta(hours = 1)))
 
   all_votes = set()
@@ -552,7 +1130,7 @@ def has_all_signatures(latest_consensus, consensuses, votes):
   "Check that the consensuses have signatures for authorities that voted on it."
 
   issues = []
-  voting_authorities = set([authority.v3ident for authority in DIRECTORY_AUTHORITIES.values() if authority.v3ident])
+  voting_authorities = set(AUTHORITIES_BY_V3IDENT.keys())
 
   for consensus_of, consensus in consensuses.items():
     signing_authorities = set([sig.identity for sig in consensus.signatures])
@@ -562,14 +1140,10 @@ def has_all_signatures(latest_consensus, consensuses, votes):
       # Attempt to translate the missing v3ident signatures into authority
       # nicknames, falling back to just notifying of the v3ident if not found.
 
-      missing_authority = missing_signature
-
-      for authority in DIRECTORY_AUTHORITIES.values():
-        if authority.v3ident == missing_signature:
-          missing_authority = authority.nickname
-          break
-
-      missing_authorities.add(missing_authority)
+      if missing_signature in AUTHORITIES_BY_V3IDENT:
+        missing_authorities.add(AUTHORITIES_BY_V3IDENT[missing_signature].nickname)
+      else:
+        missing_authorities.add(missing_signature)
 
     if missing_authorities:
       issues.append(Issue(Runlevel.NOTICE, 'MISSING_SIGNATURE', consensus_of = consensus_of, authorities = ', '.join(missing_authorities), to = missing_authorities))
@@ -640,7 +1214,8 @@ def has_authority_flag(latest_consensus, consensuses, votes):
 
   for desc in latest_consensus.routers.values():
     if Flag.AUTHORITY in desc.flags:
-      seen_authorities.add(desc.nickname)
+      authority = AUTHORITIES_BY_FINGERPRINT.get(desc.fingerprint)
+      seen_authorities.add(authority.nickname if authority else desc.nickname)
 
   known_authorities = set(DIRECTORY_AUTHORITIES.keys())
   missing_authorities = known_authorities.difference(seen_authorities)
@@ -811,6 +1386,80 @@ def bandwidth_authorities_in_sync(latest_consensus, consensuses, votes):
       return Issue(Runlevel.NOTICE, 'BANDWIDTH_AUTHORITIES_OUT_OF_SYNC', authorities = ', '.join(entries), to = measurement_counts.keys())
 
 
+def bandwidth_measurements_agree(latest_consensus, consensuses, votes):
+  """
+  Compares the bandwidth each scanner measured for the relays in the
+  consensus. This is in alarm if a scanner's median ratio to the consensus
+  weight drifts from the others, or if many relays have measurements that
+  differ wildly between scanners.
+  """
+
+  # Measurements are arranged into a column per scanner, with a row for each
+  # relay in the consensus (zero if unmeasured).
+
+  fingerprints = [fingerprint for fingerprint, desc in latest_consensus.routers.items() if desc.bandwidth]
+  row_index = dict([(fingerprint, row) for row, fingerprint in enumerate(fingerprints)])
+  weights = [latest_consensus.routers[fingerprint].bandwidth for fingerprint in fingerprints]
+  columns = {}  # {authority => list of measurements}
+
+  for authority, vote in votes.items():
+    if DIRECTORY_AUTHORITIES[authority].nickname not in BANDWIDTH_AUTHORITIES:
+      continue
+
+    column = [0] * len(fingerprints)
+
+    for fingerprint, desc in vote.routers.items():
+      row = row_index.get(fingerprint)
+
+      if row is not None and desc.measured:
+        column[row] = desc.measured
+
+    if any(column):
+      columns[authority] = column
+
+  if len(columns) < 2:
+    return
+
+  authorities = sorted(columns)
+  median_ratios = {}  # {authority => median ratio of measurement to consensus weight}
+
+  for authority in authorities:
+    median_ratios[authority] = statistics.median([measured / weight for measured, weight in zip(columns[authority], weights) if measured])
+
+  overall_ratio = statistics.median(median_ratios.values())
+  spread = max(median_ratios.values()) / min(median_ratios.values())
+  ratio_labels = ', '.join(['%s: %0.2f' % (authority, median_ratios[authority]) for authority in authorities])
+
+  disagreements = []  # (factor, fingerprint, measurements) tuples
+
+  for fingerprint, measurements in zip(fingerprints, zip(*[columns[authority] for authority in authorities])):
+    measured = [value for value in measurements if value]
+
+    if len(measured) > 1 and max(measured) > BANDWIDTH_DISAGREEMENT * min(measured):
+      disagreements.append((max(measured) / min(measured), fingerprint, measurements))
+
+  log.debug("Bandwidth scanner median ratios to consensus weight are %s (spread of %0.2fx), %i relays have measurements differing by more than %ix" % (ratio_labels, spread, len(disagreements), BANDWIDTH_DISAGREEMENT))
+
+  issues = []
+
+  for authority in authorities:
+    ratio = median_ratios[authority]
+
+    if ratio > overall_ratio * BANDWIDTH_DRIFT or ratio < overall_ratio / BANDWIDTH_DRIFT:
+      issues.append(Issue(Runlevel.NOTICE, 'BANDWIDTH_SCANNER_DRIFT', authority = authority, ratio = '%0.2f' % ratio, median = '%0.2f' % overall_ratio, ratios = ratio_labels, to = [authority]))
+
+  if len(disagreements) > MAX_DISAGREEING_RELAYS:
+    examples = []
+
+    for factor, fingerprint, measurements in sorted(disagreements, reverse = True)[:5]:
+      entries = ', '.join(['%s: %i' % (authority, value) for authority, value in zip(authorities, measurements) if value])
+      examples.append('%s (%s)' % (fingerprint, entries))
+
+    issues.append(Issue(Runlevel.NOTICE, 'BANDWIDTH_MEASUREMENTS_DISAGREE', count = len(disagreements), factor = BANDWIDTH_DISAGREEMENT, spread = '%0.2f' % spread, examples = '; '.join(examples), to = authorities))
+
+  return issues
+
+
 def is_orport_reachable(latest_consensus, consensuses, votes):
   """
   Simple check to see if we can reach the authority's ORPort.
@@ -866,7 +1515,7 @@ def shared_random_commit_partitioning(latest_consensus, consensuses, votes):
   and this just checks near the end of that.
   """
 
-  utc_hour = datetime.datetime.utcnow().hour
+  utc_hour = get_current_utc_time().hour
 
   if utc_hour < 8 or utc_hour >= 12:
     return
@@ -893,7 +1542,7 @@ def shared_random_reveal_partitioning(latest_consensus, consensuses, votes):
   that.
   """
 
-  utc_hour = datetime.datetime.utcnow().hour
+  utc_hour = get_current_utc_time().hour
 
   if utc_hour < 20:
     return
@@ -934,6 +1583,8 @@ def old_dizum_address_reachable(latest_consensus, consensuses, votes):
   """
 
   try:
+    import stem.descriptor.remote
+
     desc = stem.descriptor.remote.their_server_descriptor(endpoints = [('194.109.206.212', 80)]).run()[0]
 
     if desc.nickname != 'dizum':
@@ -942,6 +1593,36 @@ def old_dizum_address_reachable(latest_consensus, consensuses, votes):
     return Issue(Runlevel.WARNING, 'OLD_DIZUM_UNAVAILABLE', address = '194.109.206.212', error = exc, to = ['dizum'])
 
 
+# Checks that we run, along with whether they're network or CPU bound and the
+# documents they need.
+
+CHECKS = (
+  Check(missing_latest_consensus, CheckKind.CPU, ('consensuses',)),
+  Check(missing_authority_descriptor, CheckKind.CPU, ('votes',)),
+  Check(consensus_method_unsupported, CheckKind.CPU, ('consensus', 'votes')),
+  Check(different_recommended_client_version, CheckKind.CPU, ('consensus', 'votes')),
+  Check(different_recommended_server_version, CheckKind.CPU, ('consensus', 'votes')),
+  #Check(unknown_consensus_parameters, CheckKind.CPU, ('votes',)),  # tor is fiddling with these quite a bit, #24895
+  #Check(vote_parameters_mismatch_consensus, CheckKind.CPU, ('consensus', 'votes')),
+  Check(certificate_expiration, CheckKind.CPU, ()),
+  Check(consensuses_have_same_votes, CheckKind.CPU, ('consensuses',)),
+  Check(has_all_signatures, CheckKind.CPU, ('consensuses',)),
+  Check(voting_bandwidth_scanners, CheckKind.CPU, ('votes',)),
+  #Check(unmeasured_relays, CheckKind.CPU, ('consensus', 'votes')),
+  Check(has_authority_flag, CheckKind.CPU, ('consensus',)),
+  Check(has_similar_flag_counts, CheckKind.CPU, ('consensus', 'votes')),
+  Check(is_recommended_versions, CheckKind.CPU, ('consensus',)),
+  Check(bad_exits_in_sync, CheckKind.CPU, ('consensus', 'votes')),
+  Check(bandwidth_authorities_in_sync, CheckKind.CPU, ('votes',)),
+  Check(bandwidth_measurements_agree, CheckKind.CPU, ('consensus', 'votes')),
+  Check(is_orport_reachable, CheckKind.IO, ('consensus',)),
+  Check(shared_random_present, CheckKind.CPU, ('consensus',)),
+  Check(shared_random_commit_partitioning, CheckKind.CPU, ('votes',)),
+  Check(shared_random_reveal_partitioning, CheckKind.CPU, ('votes',)),
+  Check(old_dizum_address_reachable, CheckKind.IO, ()),
+)
+
+
 def get_consensuses():
   """
   Provides a mapping of directory authority nicknames to their present consensus.
@@ -973,7 +1654,7 @@ def _get_documents(label, resource):
     if authority.nickname in DIRAUTH_SKIP_CHECKS:
       continue  # checking of authority impaired
 
-    query = downloader.query(
+    query = get_downloader().query(
       resource,
       endpoints = [(authority.address, authority.dir_port)],
       default_params = False,
@@ -1005,9 +1686,22 @@ def _get_documents(label, resource):
 
 
 if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser(description = 'Checks the health of the present consensus and votes.')
+  parser.add_argument('--replay', metavar = 'PATH', help = 'replay our checks against an archive or directory of documents')
+  parser.add_argument('--since', metavar = 'YYYY-MM-DD', type = lambda arg: datetime.datetime.strptime(arg, '%Y-%m-%d'), help = 'first day to replay')
+  parser.add_argument('--until', metavar = 'YYYY-MM-DD', type = lambda arg: datetime.datetime.strptime(arg, '%Y-%m-%d'), help = 'day to stop replaying at')
+  args = parser.parse_args()
+
+  if args.replay:
+    replay(args.replay, args.since, args.until)
+    raise SystemExit()
+
   try:
     main()
   except:
     msg = "consensus_health_checker.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
+    util.flush_stem_debugging()
     util.send("Script Error", body = msg, to = [util.ERROR_ADDRESS])
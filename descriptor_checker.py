@@ -3,21 +3,42 @@
 # See LICENSE for licensing information
 
 """
-Downloads the present server descriptors, extrainfo descriptors, and consensus
-checking for any malformed entries. This is meant to be ran hourly to ensure
-that the directory authorities don't publish anything that's invalid. This
-issues an email notification when a problem is discovered.
+Downloads the present server descriptors, extrainfo descriptors,
+microdescriptors, and both consensus flavors checking for any malformed
+entries. This is meant to be ran hourly to ensure that the directory
+authorities don't publish anything that's invalid. This issues an email
+notification when a problem is discovered, or an authority's microdescriptor
+consensus disagrees with its standard consensus.
+
+Descriptors we've already validated are remembered by their digest, so each
+run only downloads and checks the descriptors that changed since the last.
+Statistics relays report in their extrainfo descriptors are pulled out as
+they're parsed and kept in columns by relay, so we can log network-wide
+totals and relays that stand out.
+Downloads are spread across the authorities and made concurrently, with a
+summary kept for each authority so problems can be traced to their source.
 """
 
+import array
+import collections
 import datetime
+import functools
+import importlib
+import math
 import os
+import random
+import re
+import time
 import traceback
+import zlib
 
+import state
 import util
 
-import stem.descriptor
-import stem.descriptor.remote
-import stem.directory
+try:
+  from urllib.request import urlopen
+except ImportError:
+  from urllib2 import urlopen
 
 EMAIL_SUBJECT = 'Unable to retrieve tor descriptors'
 
@@ -29,75 +50,900 @@ time: %s
 error: %s
 """
 
+VALIDATION_FAILURES_BODY = """\
+%i of the %i %s we downloaded were malformed...
+
+%s
+"""
+
+FLAVOR_MISMATCH_BODY = """\
+The microdescriptor consensus from %s disagrees with its consensus...
+
+%s
+"""
+
+DescriptorType = collections.namedtuple('DescriptorType', ['label', 'resource', 'keyword', 'descriptor_class', 'separator', 'batch_size'])
+ValidationFailure = collections.namedtuple('ValidationFailure', ['fingerprint', 'line', 'error'])
+ConsensusFlavor = collections.namedtuple('ConsensusFlavor', ['label', 'resource'])
+
+# Descriptor classes are named rather than referenced so stem's descriptor
+# modules are only imported when we validate. Batch sizes are stem's
+# MAX_FINGERPRINTS and MAX_MICRODESCRIPTOR_HASHES.
+
+SERVER_DESCRIPTORS = DescriptorType('server descriptors', '/tor/server/d/%s.z', b'router ', 'stem.descriptor.server_descriptor.RelayDescriptor', '+', 96)
+EXTRAINFO_DESCRIPTORS = DescriptorType('extrainfo descriptors', '/tor/extra/d/%s.z', b'extra-info ', 'stem.descriptor.extrainfo_descriptor.RelayExtraInfoDescriptor', '+', 96)
+MICRODESCRIPTORS = DescriptorType('microdescriptors', '/tor/micro/d/%s.z', b'onion-key\n', 'stem.descriptor.microdescriptor.Microdescriptor', '-', 90)
+
+CONSENSUS = ConsensusFlavor('consensus', '/tor/status-vote/current/consensus.z')
+MICRODESC_CONSENSUS = ConsensusFlavor('microdescriptor consensus', '/tor/status-vote/current/consensus-microdesc.z')
+
+# Malformed content we already know about and don't want notifications for.
+
+KNOWN_ISSUES = (
+  # https://trac.torproject.org/projects/tor/ticket/16858
+  "'dirreq-v3-ips' line had non-ascii content",
+  'Entries in dirreq-v3-ips line should only be',
+)
+
+MAX_REPORTED_FAILURES = 25  # number of validation failures we'll list in an email
+MAX_REPORTED_RELAYS = 10  # relays we'll list for each way the consensus flavors differ
+OUTLIER_THRESHOLD = 10  # standard deviations from the network's average that we log a relay for
+READ_SIZE = 64 * 1024
+FLAVOR_MISMATCH_SUPPRESSION = 24 * 60 * 60  # seconds before we'll notify again for the same flavor mismatch
+DOWNLOAD_TIMEOUT = 60  # socket timeout for our downloads
+SWEEP_TIMEOUT = 180  # seconds we'll wait on all the authorities for each kind of document
+DIGEST_CACHE_FILE = util.get_path('data', 'descriptor_digests')
+MICRODESC_DIGEST_CACHE_FILE = util.get_path('data', 'microdescriptor_digests')
+STATISTICS_FILE = util.get_path('data', 'extrainfo_statistics')
+
+# Statistics we pull from extrainfo descriptors. Directory request counts are
+# summed across countries, and bandwidth histories are averaged into bytes
+# per second.
+
+EXTRAINFO_STATISTICS = (
+  'dir_v3_requests',
+  'dir_v3_ips',
+  'read_rate',
+  'write_rate',
+  'hs_rend_cells',
+  'hs_dir_onions_seen',
+)
+
 DIRAUTH_SKIP_CHECKS = (
   'tor26',   # tor26 DirPort does not service requests without a .z suffix
   'dannenberg', # al asked for skipping the checks for now (2020-06-18)
 )
 
 log = util.get_logger('descriptor_checker')
-util.log_stem_debugging('descriptor_checker')
 
 
-def main():
-  # retrieve the server and extrainfo descriptors from any authority
-
-  targets = [
-    ('server descriptors', '/tor/server/all.z'),
-    ('extrainfo descriptors', '/tor/extra/all.z'),
-  ]
-
-  for descriptor_type, resource in targets:
-    log.debug("Downloading %s..." % descriptor_type)
-
-    query = stem.descriptor.remote.Query(
-      resource,
-      block = True,
-      timeout = 60,
-      validate = True,
-    )
-
-    if not query.error:
-      count = len(list(query))
-      log.debug("  %i descriptors retrieved from %s in %0.2fs" % (count, query.download_url, query.runtime))
-    elif "'dirreq-v3-ips' line had non-ascii content" in str(query.error) or "Entries in dirreq-v3-ips line should only be" in str(query.error):
-      log.debug("Suppressing error due to malformed dirreq-v3-ips line: https://trac.torproject.org/projects/tor/ticket/16858")
+class ValidationSummary(object):
+  """
+  Running tally of what we've downloaded and validated from an authority.
+
+  :var int count: number of descriptors we've processed
+  :var int size: bytes of (decompressed) content we've processed
+  :var float runtime: seconds spent downloading and validating
+  :var list failures: **ValidationFailure** for each malformed descriptor
+  :var list errors: (url, exception) tuples for downloads that failed
+  :var dict digests: mapping of valid descriptors' digests to the digest of
+    their extrainfo descriptor (**None** if they don't have one)
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.size = 0
+    self.runtime = 0.0
+    self.failures = []
+    self.errors = []
+    self.digests = {}
+
+  def merge(self, summary):
+    """
+    Adds another summary's results to our own.
+
+    :param ValidationSummary summary: results to include
+    """
+
+    self.count += summary.count
+    self.size += summary.size
+    self.runtime += summary.runtime
+    self.failures += summary.failures
+    self.errors += summary.errors
+    self.digests.update(summary.digests)
+
+  def __str__(self):
+    msg = '%i in %0.2fs (%i KB, %i malformed)' % (self.count, self.runtime, self.size / 1024, len(self.failures))
+
+    if self.errors:
+      msg += ', %i failed downloads: %s' % (len(self.errors), self.errors[0][1])
+
+    return msg
+
+
+class ExtrainfoStatistics(object):
+  """
+  Statistics relays report in their extrainfo descriptors, with a row for
+  each relay and an array for each statistic (NaN if the relay didn't report
+  it). Running sums are kept as rows change, so network-wide totals are
+  available without going over the rows and outliers take a single pass.
+
+  :var list fingerprints: relay of each row
+  :var dict columns: mapping of statistic names to an **array** of their values
+  """
+
+  def __init__(self):
+    self.fingerprints = []
+    self.columns = collections.OrderedDict([(name, array.array('d')) for name in EXTRAINFO_STATISTICS])
+    self._rows = {}  # {fingerprint => row index}
+    self._sums = dict([(name, [0, 0.0, 0.0]) for name in EXTRAINFO_STATISTICS])  # {name => [count, sum, sum of squares]}
+
+  def add(self, desc):
+    """
+    Records the statistics of an extrainfo descriptor, replacing any we had
+    for its relay.
+
+    :param stem.descriptor.extrainfo_descriptor.RelayExtraInfoDescriptor desc:
+      descriptor to record
+    """
+
+    self.set(desc.fingerprint, _extrainfo_statistics(desc))
+
+  def set(self, fingerprint, values):
+    """
+    Records a relay's statistics.
+
+    :param str fingerprint: relay the statistics are for
+    :param tuple values: value of each statistic in **EXTRAINFO_STATISTICS**
+    """
+
+    index = self._rows.get(fingerprint)
+
+    if index is None:
+      self._rows[fingerprint] = len(self.fingerprints)
+      self.fingerprints.append(fingerprint)
+
+      for name, value in zip(EXTRAINFO_STATISTICS, values):
+        self.columns[name].append(value)
+        self._tally(name, value, 1)
     else:
-      log.warn("Unable to retrieve the %s: %s" % (descriptor_type, query.error))
-      send_email(EMAIL_SUBJECT, descriptor_type, query)
-
-  # download the consensus from each authority
-
-  for authority in stem.directory.Authority.from_cache().values():
-    if authority.v3ident is None:
-      continue  # authority doesn't vote in the consensus
-    elif authority.nickname in DIRAUTH_SKIP_CHECKS:
-      continue  # checking of authority impaired
-
-    log.debug("Downloading the consensus from %s..." % authority.nickname)
-
-    query = stem.descriptor.remote.Query(
-      '/tor/status-vote/current/consensus.z',
-      block = True,
-      timeout = 60,
-      endpoints = [(authority.address, authority.dir_port)],
-      document_handler = stem.descriptor.DocumentHandler.DOCUMENT,
-      validate = True,
-    )
-
-    if not query.error:
-      count = len(list(query)[0].routers)
-      log.debug("  %i descriptors retrieved from %s in %0.2fs" % (count, query.download_url, query.runtime))
+      for name, value in zip(EXTRAINFO_STATISTICS, values):
+        self._tally(name, self.columns[name][index], -1)
+        self.columns[name][index] = value
+        self._tally(name, value, 1)
+
+  def row(self, fingerprint):
+    """
+    Provides a relay's statistics.
+
+    :param str fingerprint: relay to provide statistics for
+
+    :returns: **tuple** with the value of each statistic, **None** if we don't
+      have the relay
+    """
+
+    index = self._rows.get(fingerprint)
+    return None if index is None else tuple([self.columns[name][index] for name in EXTRAINFO_STATISTICS])
+
+  def remove(self, fingerprint):
+    """
+    Drops a relay's statistics. Our last row takes its place, so this doesn't
+    shift the rest of our arrays.
+
+    :param str fingerprint: relay to drop
+    """
+
+    index = self._rows.pop(fingerprint, None)
+
+    if index is None:
+      return
+
+    last_fingerprint = self.fingerprints.pop()
+
+    for name, column in self.columns.items():
+      self._tally(name, column[index], -1)
+      last_value = column.pop()
+
+      if last_fingerprint != fingerprint:
+        column[index] = last_value
+
+    if last_fingerprint != fingerprint:
+      self.fingerprints[index] = last_fingerprint
+      self._rows[last_fingerprint] = index
+
+  def merge(self, statistics):
+    """
+    Adds another set of statistics to our own, replacing those we have for
+    the same relays.
+
+    :param ExtrainfoStatistics statistics: statistics to include
+    """
+
+    for fingerprint in statistics.fingerprints:
+      self.set(fingerprint, statistics.row(fingerprint))
+
+  def retain(self, fingerprints):
+    """
+    Drops relays that aren't among the given fingerprints.
+
+    :param set fingerprints: relays to keep
+    """
+
+    for fingerprint in [fp for fp in self.fingerprints if fp not in fingerprints]:
+      self.remove(fingerprint)
+
+  def totals(self):
+    """
+    Provides the network-wide total of each statistic.
+
+    :returns: **OrderedDict** mapping statistic names to (total, count)
+      tuples, the count being the number of relays that reported it
+    """
+
+    return collections.OrderedDict([(name, (self._sums[name][1], self._sums[name][0])) for name in EXTRAINFO_STATISTICS])
+
+  def outliers(self, threshold = OUTLIER_THRESHOLD):
+    """
+    Provides relays whose statistics are far above the network's average.
+
+    :param float threshold: standard deviations above the average a value
+      must be to be an outlier
+
+    :returns: **list** of (statistic, fingerprint, value, zscore) tuples
+    """
+
+    outliers = []
+
+    for name, column in self.columns.items():
+      count, total, total_squares = self._sums[name]
+
+      if count < 2:
+        continue
+
+      mean = total / count
+      deviation = math.sqrt(max(0.0, total_squares / count - mean * mean))
+
+      if deviation == 0:
+        continue
+
+      for fingerprint, value in zip(self.fingerprints, column):
+        if value > mean + threshold * deviation:  # false for NaN
+          outliers.append((name, fingerprint, value, (value - mean) / deviation))
+
+    return outliers
+
+  def _tally(self, name, value, sign):
+    if not math.isnan(value):
+      sums = self._sums[name]
+      sums[0] += sign
+      sums[1] += sign * value
+      sums[2] += sign * value * value
+
+  def __len__(self):
+    return len(self.fingerprints)
+
+
+def main():
+  if not util.acquire_run_lock('descriptor_checker'):
+    log.warn("Our previous run is still active. Skipping this one so we don't add to the load on the authorities.")
+    return
+
+  util.log_stem_debugging('descriptor_checker')
+
+  import stem.directory  # deferred, it's costly to import
+
+  authorities = [auth for auth in stem.directory.Authority.from_cache().values() if auth.v3ident and auth.nickname not in DIRAUTH_SKIP_CHECKS]
+  random.shuffle(authorities)  # vary who serves which descriptors
+
+  reports = collections.OrderedDict([(auth.nickname, collections.OrderedDict()) for auth in authorities])  # {authority => {document type => ValidationSummary}}
+
+  # download both consensus flavors from every authority at once
+
+  log.debug("Downloading the consensus and microdescriptor consensus from %s..." % ', '.join(reports.keys()))
+
+  flavors = (CONSENSUS, MICRODESC_CONSENSUS)
+  tasks = [((auth.nickname, label), functools.partial(fetch_consensus, auth, resource)) for auth in authorities for label, resource in flavors]
+  results = util.run_in_threads(tasks, max_workers = len(tasks), timeout = SWEEP_TIMEOUT)
+  suppressions = util.SuppressionStore('descriptor_checker_last_notified', default_duration = FLAVOR_MISMATCH_SUPPRESSION)
+  latest = {}  # {flavor => newest consensus of that flavor}
+  available = {}  # {flavor => authorities that provided it}
+
+  for authority in authorities:
+    documents = {}  # {flavor => consensus from this authority}
+
+    for label, _ in flavors:
+      result, exc = results.get((authority.nickname, label), (None, IOError('timed out after %i seconds' % SWEEP_TIMEOUT)))
+
+      if exc:
+        document, summary = None, ValidationSummary()
+        summary.errors.append((None, exc))
+      else:
+        document, summary = result
+
+      reports[authority.nickname][label] = summary
+
+      if document:
+        log.debug("  %i entries in the %s from %s, retrieved in %0.2fs" % (len(document.routers), label, authority.nickname, summary.runtime))
+        documents[label] = document
+        available.setdefault(label, []).append(authority)
+
+        if label not in latest or document.valid_after > latest[label].valid_after:
+          latest[label] = document
+      else:
+        url, error = summary.errors[0] if summary.errors else (None, summary.failures[0].error)
+        log.warn("Unable to retrieve the %s from %s: %s" % (label, authority.nickname, error))
+
+        subject = EMAIL_SUBJECT + ' (%s)' % authority.nickname
+        send_email(subject, label, url or authority.nickname, error)
+
+    if len(documents) == len(flavors):
+      differences = compare_flavors(documents[CONSENSUS.label], documents[MICRODESC_CONSENSUS.label])
+
+      if differences:
+        descriptions = [description for _, description in differences]
+        log.warn("The consensus flavors from %s disagree: %s" % (authority.nickname, ' '.join(descriptions)))
+
+        # the relays involved vary between consensuses, so we only notify again
+        # if the authority's flavors start to differ in another way
+
+        key = '%s:%s' % (authority.nickname, ','.join([kind for kind, _ in differences]))
+
+        if suppressions.remaining(key, FLAVOR_MISMATCH_SUPPRESSION) > 0:
+          log.debug("We already notified for this mismatch recently, suppressed for %i hours" % (suppressions.remaining(key, FLAVOR_MISMATCH_SUPPRESSION) / 3600))
+        else:
+          send_flavor_mismatch_email(authority.nickname, descriptions)
+          suppressions.mark(key, FLAVOR_MISMATCH_SUPPRESSION)
+
+  suppressions.commit()
+
+  # Microdescriptors are only referenced by the microdescriptor consensus, so
+  # they're fetched even if the standard consensus is unavailable.
+
+  if MICRODESC_CONSENSUS.label in latest:
+    known_microdesc_digests = load_digests(MICRODESC_DIGEST_CACHE_FILE)
+    current_microdesc_digests = set([entry.microdescriptor_digest for entry in latest[MICRODESC_CONSENSUS.label].routers.values()])
+    new_microdesc_digests = current_microdesc_digests.difference(known_microdesc_digests)
+
+    log.debug("%i of the %i microdescriptors in the microdescriptor consensus are new" % (len(new_microdesc_digests), len(current_microdesc_digests)))
+
+    microdescriptors = validate_digests(available[MICRODESC_CONSENSUS.label], MICRODESCRIPTORS, new_microdesc_digests, reports)
+    save_digests(dict([(digest, None) for digest in current_microdesc_digests if digest in known_microdesc_digests or digest in microdescriptors.digests]), MICRODESC_DIGEST_CACHE_FILE)
+
+  if CONSENSUS.label not in latest:
+    log.warn("Unable to retrieve any consensus, skipping descriptor validation")
+    return
+
+  consensus = latest[CONSENSUS.label]
+
+  # retrieve the server and extrainfo descriptors that have changed since our
+  # last run, spreading them across the authorities that are responsive
+
+  known_digests = load_digests()
+  current_digests = set([desc.digest for desc in consensus.routers.values()])
+  new_digests = current_digests.difference(known_digests)
+
+  log.debug("%i of the %i server descriptors in the consensus are new" % (len(new_digests), len(current_digests)))
+
+  servers = validate_digests(available[CONSENSUS.label], SERVER_DESCRIPTORS, new_digests, reports)
+
+  # Extrainfo statistics of the relays whose descriptors changed replace
+  # those we had, covering the whole network once we've seen each relay.
+
+  statistics = load_statistics()
+  new_extrainfo_digests = set([digest for digest in servers.digests.values() if digest])
+  seeding = not statistics
+
+  if seeding:
+    # Without prior statistics we'd only have those of relays whose extrainfo
+    # changed, so fetch the extrainfo we validated on earlier runs once too.
+
+    prior_extrainfo_digests = [extrainfo_digest for digest, extrainfo_digest in known_digests.items() if digest in current_digests and extrainfo_digest]
+    log.debug("We lack extrainfo statistics, so refetching %i previously validated extrainfo descriptors" % len(prior_extrainfo_digests))
+    new_extrainfo_digests.update(prior_extrainfo_digests)
+
+  extrainfo = validate_digests(available[CONSENSUS.label], EXTRAINFO_DESCRIPTORS, new_extrainfo_digests, reports, statistics)
+
+  # Remember the descriptors that were valid along with their extrainfo. If
+  # either was malformed or missing we'll retry it next run, as we will for
+  # extrainfo we were unable to refetch for our statistics.
+
+  def is_valid(extrainfo_digest):
+    return extrainfo_digest is None or extrainfo_digest in extrainfo.digests
+
+  digests = dict((digest, extrainfo_digest) for (digest, extrainfo_digest) in known_digests.items() if digest in current_digests and (not seeding or is_valid(extrainfo_digest)))
+
+  for digest, extrainfo_digest in servers.digests.items():
+    if is_valid(extrainfo_digest):
+      digests[digest] = extrainfo_digest
+
+  save_digests(digests)
+
+  statistics.retain(set(consensus.routers))
+  save_statistics(statistics)
+  report_statistics(statistics)
+
+  log.debug("Results by authority...")
+
+  for nickname, summaries in reports.items():
+    for document_type, summary in summaries.items():
+      log.debug("  %s %s: %s" % (nickname, document_type, summary))
+
+
+def fetch_consensus(authority, resource = CONSENSUS.resource):
+  """
+  Downloads and validates the consensus from an authority.
+
+  :param stem.directory.Authority authority: authority to download from
+  :param str resource: consensus flavor to download
+
+  :returns: tuple of the form (consensus, ValidationSummary), the consensus
+    being **None** if it was unavailable or malformed
+  """
+
+  import stem.descriptor.remote  # deferred, it's costly to import
+
+  summary = ValidationSummary()
+
+  query = stem.descriptor.remote.Query(
+    resource,
+    block = True,
+    timeout = DOWNLOAD_TIMEOUT,
+    endpoints = [(authority.address, authority.dir_port)],
+    document_handler = stem.descriptor.DocumentHandler.DOCUMENT,
+    validate = True,
+  )
+
+  summary.runtime = query.runtime or 0.0
+  summary.size = len(getattr(query, 'content', None) or b'')
+
+  if isinstance(query.error, ValueError):
+    summary.failures.append(ValidationFailure(authority.fingerprint, None, str(query.error)))
+    return None, summary
+  elif query.error:
+    summary.errors.append((query.download_url, query.error))
+    return None, summary
+
+  consensus = list(query)[0]
+  summary.count = len(consensus.routers)
+
+  return consensus, summary
+
+
+def validate_digests(authorities, descriptor_type, digests, reports, statistics = None):
+  """
+  Downloads and validates the descriptors with the given digests. These are
+  requested in batches that are spread across the authorities and fetched
+  concurrently.
+
+  :param list authorities: authorities to download from
+  :param DescriptorType descriptor_type: kind of descriptors to download
+  :param set digests: hex digests of the descriptors to download
+  :param dict reports: per-authority summaries to add our results to
+  :param ExtrainfoStatistics statistics: adds the statistics of extrainfo
+    descriptors to this if provided
+
+  :returns: **ValidationSummary** for all the descriptors we validated
+  """
+
+  digests = sorted(digests)
+  tasks = []
+
+  batch_size = descriptor_type.batch_size
+
+  for i in range(0, len(digests), batch_size):
+    authority = authorities[(i // batch_size) % len(authorities)]
+    url = 'http://%s:%i%s' % (authority.address, authority.dir_port, descriptor_type.resource % descriptor_type.separator.join(digests[i:i + batch_size]))
+    tasks.append(((authority.nickname, url), functools.partial(_validate_batch, url, descriptor_type, statistics is not None)))
+
+  results = util.run_in_threads(tasks, max_workers = len(authorities), timeout = SWEEP_TIMEOUT)
+  combined = ValidationSummary()
+
+  for (nickname, url), _ in tasks:
+    summary = reports[nickname].setdefault(descriptor_type.label, ValidationSummary())
+    result, exc = results.get((nickname, url), (None, IOError('timed out after %i seconds' % SWEEP_TIMEOUT)))
+
+    if exc:
+      summary.errors.append((url, exc))
     else:
-      log.warn("Unable to retrieve the consensus from %s: %s" % (authority.nickname, query.error))
+      batch, batch_statistics = result
+      summary.merge(batch)
+      combined.merge(batch)
+
+      if batch_statistics:
+        statistics.merge(batch_statistics)
+
+  log.debug("  %i of %i %s retrieved" % (combined.count, len(digests), descriptor_type.label))
+
+  for nickname, summaries in reports.items():
+    summary = summaries.get(descriptor_type.label)
+
+    if summary and summary.errors:
+      url, exc = summary.errors[0]
+      log.warn("Unable to retrieve %i batches of %s from %s: %s" % (len(summary.errors), descriptor_type.label, nickname, exc))
+      send_email(EMAIL_SUBJECT + ' (%s)' % nickname, descriptor_type.label, url, exc)
+
+  if combined.failures:
+    log.warn("%i of the %i %s were malformed" % (len(combined.failures), combined.count, descriptor_type.label))
+    send_validation_email(descriptor_type.label, reports)
+
+  return combined
+
+
+def _validate_batch(url, descriptor_type, collect_statistics):
+  # batches run on their own threads, so each collects statistics separately
+
+  start_time = time.time()
+  statistics = ExtrainfoStatistics() if collect_statistics else None
+  summary = validate_descriptors(url, descriptor_type, timeout = DOWNLOAD_TIMEOUT, statistics = statistics)
+  summary.runtime = time.time() - start_time
+
+  return summary, statistics
+
+
+def load_digests(path = DIGEST_CACHE_FILE):
+  """
+  Loads the digests of descriptors we've previously validated.
+
+  :param str path: cache to read the digests from
+
+  :returns: **dict** mapping server descriptor digests to their extrainfo
+    descriptor's digest (**None** if they don't have one)
+  """
+
+  digests = {}
+
+  if not os.path.exists(path):
+    log.debug("  '%s' doesn't exist" % path)
+    return digests
+
+  try:
+    with open(path) as cache_file:
+      for line in cache_file:
+        if line.strip():
+          digest, extrainfo_digest = line.split()
+          digests[digest] = extrainfo_digest if extrainfo_digest != '-' else None
+  except Exception as exc:
+    log.debug("  unable to read '%s': %s" % (path, exc))
+    return {}
+
+  log.debug("  %i validated descriptor digests loaded" % len(digests))
+  return digests
+
+
+def save_digests(digests, path = DIGEST_CACHE_FILE):
+  content = ''.join(['%s %s\n' % (digest, extrainfo_digest or '-') for digest, extrainfo_digest in digests.items()])
+
+  try:
+    util.atomic_write(path, content)
+  except Exception as exc:
+    log.debug("Unable to save descriptor digests to '%s': %s" % (path, exc))
+
+
+def load_statistics():
+  """
+  Loads the extrainfo statistics we've collected on prior runs.
+
+  :returns: **ExtrainfoStatistics** with the statistics of each relay
+  """
+
+  statistics = ExtrainfoStatistics()
+
+  if not os.path.exists(STATISTICS_FILE):
+    log.debug("  '%s' doesn't exist" % STATISTICS_FILE)
+    return statistics
+
+  try:
+    with open(STATISTICS_FILE) as statistics_file:
+      if statistics_file.readline().split()[1:] != list(EXTRAINFO_STATISTICS):
+        log.debug("  '%s' has different statistics than we collect, ignoring it" % STATISTICS_FILE)
+        return statistics
+
+      for line in statistics_file:
+        entry = line.split()
+
+        if len(entry) == len(EXTRAINFO_STATISTICS) + 1:
+          statistics.set(entry[0], tuple([float('nan') if value == '-' else float(value) for value in entry[1:]]))
+  except Exception as exc:
+    log.debug("  unable to read '%s': %s" % (STATISTICS_FILE, exc))
+    return ExtrainfoStatistics()
+
+  log.debug("  extrainfo statistics for %i relays loaded" % len(statistics))
+  return statistics
 
-      subject = EMAIL_SUBJECT + ' (%s)' % authority.nickname
-      send_email(subject, 'consensus', query)
 
+def save_statistics(statistics):
+  lines = ['# %s\n' % ' '.join(EXTRAINFO_STATISTICS)]
+
+  for fingerprint in statistics.fingerprints:
+    lines.append('%s %s\n' % (fingerprint, ' '.join(['-' if math.isnan(value) else '%0.0f' % value for value in statistics.row(fingerprint)])))
 
-def send_email(subject, descriptor_type, query):
+  try:
+    util.atomic_write(STATISTICS_FILE, ''.join(lines))
+  except Exception as exc:
+    log.debug("Unable to save extrainfo statistics to '%s': %s" % (STATISTICS_FILE, exc))
+
+
+def report_statistics(statistics):
+  """
+  Logs network-wide totals of our extrainfo statistics and the relays that
+  stand out, and records the totals as measurements so we can see how they
+  change over time.
+
+  :param ExtrainfoStatistics statistics: statistics of the relays in the
+    consensus
+  """
+
+  totals = statistics.totals()
+
+  log.info("Extrainfo statistics of %i relays..." % len(statistics))
+
+  for name, (total, count) in totals.items():
+    log.info("  %s: %0.0f from %i relays" % (name, total, count))
+
+  for name, fingerprint, value, zscore in sorted(statistics.outliers(), key = lambda outlier: -outlier[3])[:MAX_REPORTED_RELAYS]:
+    log.info("  %s reported %s of %0.0f (%0.1f standard deviations above average)" % (fingerprint, name, value, zscore))
+
+  try:
+    state.get_store().add_measurements([('extrainfo.%s' % name, total) for name, (total, count) in totals.items() if count])
+  except Exception as exc:
+    log.debug("Unable to record extrainfo statistics: %s" % exc)
+
+
+def compare_flavors(consensus, microdesc_consensus):
+  """
+  Checks that an authority's microdescriptor consensus agrees with its
+  standard consensus. Both are made from the same votes, so they should have
+  the same valid-after time, relays, and flags.
+
+  :param stem.descriptor.networkstatus.NetworkStatusDocumentV3 consensus:
+    standard consensus from the authority
+  :param stem.descriptor.networkstatus.NetworkStatusDocumentV3 microdesc_consensus:
+    microdescriptor consensus from the authority
+
+  :returns: **list** of (kind, description) tuples for how they differ, the
+    kind being 'valid_after', 'missing', 'extra', or 'flags'
+  """
+
+  if consensus.valid_after != microdesc_consensus.valid_after:
+    # relays are expected to differ between hours, so that's all we check
+
+    return [('valid_after', 'The consensus is valid after %s but the microdescriptor consensus is valid after %s.' % (consensus.valid_after, microdesc_consensus.valid_after))]
+
+  differences = []
+  relays, microdesc_relays = consensus.routers, microdesc_consensus.routers  # {fingerprint => router status entry}
+
+  missing = sorted(set(relays).difference(microdesc_relays))
+  extra = sorted(set(microdesc_relays).difference(relays))
+  different_flags = sorted([fingerprint for fingerprint in set(relays).intersection(microdesc_relays) if set(relays[fingerprint].flags) != set(microdesc_relays[fingerprint].flags)])
+
+  if missing:
+    differences.append(('missing', '%i relays are missing from the microdescriptor consensus: %s' % (len(missing), _relay_list(missing))))
+
+  if extra:
+    differences.append(('extra', '%i relays are only in the microdescriptor consensus: %s' % (len(extra), _relay_list(extra))))
+
+  if different_flags:
+    entries = ['%s (%s => %s)' % (fingerprint, ' '.join(sorted(relays[fingerprint].flags)), ' '.join(sorted(microdesc_relays[fingerprint].flags))) for fingerprint in different_flags[:MAX_REPORTED_RELAYS]]
+    differences.append(('flags', '%i relays have different flags in the microdescriptor consensus: %s' % (len(different_flags), _relay_list(entries, len(different_flags)))))
+
+  return differences
+
+
+def _relay_list(entries, count = None):
+  count = len(entries) if count is None else count
+  label = ', '.join(entries[:MAX_REPORTED_RELAYS])
+
+  if count > MAX_REPORTED_RELAYS:
+    label += ', and %i more' % (count - MAX_REPORTED_RELAYS)
+
+  return label
+
+
+def stream_descriptors(url, keyword, timeout = 60):
+  """
+  Downloads and decompresses a listing of descriptors incrementally, providing
+  each descriptor's content as soon as it's complete. Only a single
+  descriptor's worth of content is held in memory at a time.
+
+  :param str url: location to download descriptors from
+  :param bytes keyword: keyword of the first line of each descriptor
+  :param int timeout: socket timeout for the download
+
+  :returns: iterator for the **bytes** content of each descriptor
+
+  :raises: **IOError** if the download fails or its content is corrupted
+  """
+
+  response = urlopen(url, timeout = timeout)
+  decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)  # zlib or gzip
+  divider = b'\n' + keyword
+  pending = b''
+
+  try:
+    while True:
+      chunk = response.read(READ_SIZE)
+
+      try:
+        pending += decompressor.decompress(chunk) if chunk else decompressor.flush()
+      except zlib.error as exc:
+        raise IOError('Unable to decompress %s: %s' % (url, exc))
+
+      start = 0
+
+      while True:
+        index = pending.find(divider, start)
+
+        if index == -1:
+          break
+
+        content, start = pending[start:index + 1], index + 1
+
+        if content.strip():
+          yield content
+
+      pending = pending[start:]
+
+      if not chunk:
+        break
+  finally:
+    response.close()
+
+  if pending.strip():
+    yield pending
+
+
+def validate_descriptors(url, descriptor_type, summary = None, timeout = 60, statistics = None):
+  """
+  Downloads and validates descriptors one at a time.
+
+  :param str url: location to download descriptors from
+  :param DescriptorType descriptor_type: kind of descriptors being downloaded
+  :param ValidationSummary summary: tally to add our results to
+  :param int timeout: socket timeout for the download
+  :param ExtrainfoStatistics statistics: adds the statistics of extrainfo
+    descriptors to this if provided
+
+  :returns: **ValidationSummary** with our results
+
+  :raises: **IOError** if the download fails
+  """
+
+  if summary is None:
+    summary = ValidationSummary()
+
+  module_name, class_name = descriptor_type.descriptor_class.rsplit('.', 1)
+  descriptor_class = getattr(importlib.import_module(module_name), class_name)  # deferred, it's costly to import
+
+  for content in stream_descriptors(url, descriptor_type.keyword, timeout):
+    summary.count += 1
+    summary.size += len(content)
+
+    try:
+      desc = descriptor_class(content, validate = True)
+    except ValueError as exc:
+      failure = ValidationFailure(_fingerprint(content), _offending_line(content, exc), str(exc))
+
+      if any([issue in failure.error for issue in KNOWN_ISSUES]):
+        log.debug("Suppressing known issue with %s: %s" % (failure.fingerprint, failure.error))
+        desc = descriptor_class(content, validate = False)
+      else:
+        log.debug("Malformed descriptor from %s: %s" % (failure.fingerprint, failure.error))
+        summary.failures.append(failure)
+        continue
+
+    summary.digests[desc.digest()] = getattr(desc, 'extra_info_digest', None)
+
+    if statistics is not None and descriptor_type == EXTRAINFO_DESCRIPTORS:
+      statistics.add(desc)
+
+  return summary
+
+
+def _extrainfo_statistics(desc):
+  """
+  Provides the value of each of our EXTRAINFO_STATISTICS for a descriptor,
+  NaN for those it lacks.
+  """
+
+  def rate(values, interval):
+    return float(sum(values)) / (len(values) * interval) if values and interval else float('nan')
+
+  def total(counts):
+    return float(sum(counts.values())) if counts else float('nan')
+
+  def value(count):
+    return float(count) if count is not None else float('nan')
+
+  return (
+    total(desc.dir_v3_requests),
+    total(desc.dir_v3_ips),
+    rate(desc.read_history_values, desc.read_history_interval),
+    rate(desc.write_history_values, desc.write_history_interval),
+    value(desc.hs_rend_cells),
+    value(desc.hs_dir_onions_seen),
+  )
+
+
+def _fingerprint(content):
+  """
+  Best effort attempt to get a descriptor's fingerprint without parsing it.
+  """
+
+  server_match = re.search(br'^fingerprint (.+)$', content, re.MULTILINE)
+  extrainfo_match = re.search(br'^extra-info \S+ (\S+)', content, re.MULTILINE)
+
+  if server_match:
+    return server_match.group(1).replace(b' ', b'').decode('utf-8', 'replace')
+  elif extrainfo_match:
+    return extrainfo_match.group(1).decode('utf-8', 'replace')
+  else:
+    return 'unknown'
+
+
+def _offending_line(content, exc):
+  """
+  Provides the line of a descriptor that a validation error concerns. Stem's
+  errors usually name the keyword of the line they took issue with, such as
+  "Malformed write-history line" or "'dirreq-v3-ips' line had...".
+  """
+
+  keyword_match = re.search(r"([\w-]+)'? line", str(exc))
+
+  if keyword_match:
+    keyword = keyword_match.group(1).lower().encode('utf-8')
+
+    for line in content.splitlines():
+      if line == keyword or line.startswith(keyword + b' '):
+        return line.decode('utf-8', 'replace')
+
+  return None
+
+
+def send_email(subject, descriptor_type, source, error):
   try:
     timestamp = datetime.datetime.now().strftime("%m/%d/%Y %H:%M")
-    util.send(subject, body = EMAIL_BODY % (descriptor_type, query.download_url, timestamp, query.error), to = [util.ERROR_ADDRESS])
+    util.send(subject, body = EMAIL_BODY % (descriptor_type, source, timestamp, error), to = [util.ERROR_ADDRESS])
+  except Exception as exc:
+    log.warn("Unable to send email: %s" % exc)
+
+
+def send_validation_email(descriptor_type, reports):
+  count, failures, entries = 0, 0, []
+
+  for nickname, summaries in reports.items():
+    summary = summaries.get(descriptor_type)
+
+    if not summary:
+      continue
+
+    count += summary.count
+    failures += len(summary.failures)
+
+    if summary.failures:
+      entries.append('%s served %i malformed of %i...' % (nickname, len(summary.failures), summary.count))
+
+      for failure in summary.failures[:MAX_REPORTED_FAILURES]:
+        entries.append('* %s: %s' % (failure.fingerprint, failure.error))
+
+        if failure.line:
+          entries.append('  line: %s' % failure.line)
+
+      if len(summary.failures) > MAX_REPORTED_FAILURES:
+        entries.append('... and %i more' % (len(summary.failures) - MAX_REPORTED_FAILURES))
+
+      entries.append('')
+
+  try:
+    body = VALIDATION_FAILURES_BODY % (failures, count, descriptor_type, '\n'.join(entries))
+    util.send('Malformed %s' % descriptor_type, body = body, to = [util.ERROR_ADDRESS])
+  except Exception as exc:
+    log.warn("Unable to send email: %s" % exc)
+
+
+def send_flavor_mismatch_email(authority, differences):
+  try:
+    body = FLAVOR_MISMATCH_BODY % (authority, '\n\n'.join(['* %s' % difference for difference in differences]))
+    util.send('Consensus flavors disagree (%s)' % authority, body = body, to = [util.ERROR_ADDRESS])
   except Exception as exc:
     log.warn("Unable to send email: %s" % exc)
 
@@ -108,4 +954,5 @@ if __name__ == '__main__':
   except:
     msg = "descriptor_checker.py failed with:\n\n%s" % traceback.format_exc()
     log.error(msg)
+    util.flush_stem_debugging()
     util.send("Script Error", body = msg, to = [util.ERROR_ADDRESS])
@@ -9,9 +9,6 @@ Report for how many of our fallback directories are unreachable.
 import time
 import traceback
 
-import stem.descriptor.remote
-import stem.directory
-
 import util
 
 log = util.get_logger('fallback_directories')
@@ -21,10 +18,17 @@ TO_ADDRESSES = ['tor-consensus-health@lists.torproject.org', 'dgoulet@torproject
 EMAIL_SUBJECT = 'Fallback Directory Summary (%i/%i, %i%%)'
 SYNOPSIS = '%i/%i (%i%%) fallback directories have become slow or unresponsive...'
 
-downloader = stem.descriptor.remote.DescriptorDownloader(timeout = 30)
-
 
 def main():
+  if not util.acquire_run_lock('fallback_directories'):
+    log.warn("Our previous run is still active, skipping this one.")
+    return
+
+  import stem.descriptor.remote  # deferred, these are costly to import
+  import stem.directory
+
+  downloader = stem.descriptor.remote.DescriptorDownloader(timeout = 30)
+
   try:
     fallback_directories = stem.directory.Fallback.from_remote().values()
     log.info('Retrieved %i fallback directories' % len(fallback_directories))
@@ -8,14 +8,13 @@ This can indicate malicious intent toward hidden services.
 """
 
 import datetime
-import os
 import time
 import traceback
 
+import state
 import util
 
-from stem.descriptor.remote import DescriptorDownloader
-from stem.util import datetime_to_unix, conf
+from stem.util import datetime_to_unix
 
 EMAIL_SUBJECT = 'Relays Changing Fingerprint'
 
@@ -24,7 +23,6 @@ The following relays are frequently changing their fingerprints...
 
 """
 
-FINGERPRINT_CHANGES_FILE = util.get_path('data', 'fingerprint_changes')
 ONE_DAY = 24 * 60 * 60
 TEN_DAYS = 10 * 24 * 60 * 60
 
@@ -32,16 +30,27 @@ log = util.get_logger('fingerprint_change_checker')
 
 
 def main():
-  last_notified_config = conf.get_config('last_notified')
-  last_notified_path = util.get_path('data', 'fingerprint_change_last_notified.cfg')
+  if not util.acquire_run_lock('fingerprint_change_checker'):
+    log.warn("Our previous run is still active, skipping this one.")
+    return
 
-  if os.path.exists(last_notified_path):
-    last_notified_config.load(last_notified_path)
-  else:
-    last_notified_config._path = last_notified_path
+  suppressions = util.SuppressionStore('fingerprint_change_last_notified', default_duration = ONE_DAY)
+
+  from stem.descriptor.remote import DescriptorDownloader  # deferred, it's costly to import
+
+  # drop fingerprint changes that are over ten days old
+
+  store = state.get_store()
+  pruned = store.prune_fingerprint_changes(time.time() - TEN_DAYS)
+
+  if pruned:
+    log.debug("Removed %i fingerprints that were published over ten days ago" % pruned)
+
+  fingerprint_changes = store.fingerprint_changes()
+  log.debug("Fingerprint information for %i relays found" % len(fingerprint_changes))
 
-  fingerprint_changes = load_fingerprint_changes()
   downloader = DescriptorDownloader(timeout = 15)
+  new_fingerprints = []  # (address, or_port, fingerprint, published) tuples to persist
   alarm_for = {}
 
   for relay in downloader.get_consensus():
@@ -50,21 +59,14 @@ def main():
     if relay.fingerprint not in prior_fingerprints:
       log.debug("Registering a new fingerprint for %s:%s (%s)" % (relay.address, relay.or_port, relay.fingerprint))
       prior_fingerprints[relay.fingerprint] = datetime_to_unix(relay.published)
-
-      # drop fingerprint changes that are over thirty days old
-
-      old_fingerprints = [fp for fp in prior_fingerprints if (time.time() - prior_fingerprints[fp] > TEN_DAYS)]
-
-      for fp in old_fingerprints:
-        log.debug("Removing fingerprint for %s:%s (%s) which was published %i days ago" % (relay.address, relay.or_port, fp, prior_fingerprints[fp] / 60 / 60 / 24))
-        del prior_fingerprints[fp]
+      new_fingerprints.append((relay.address, relay.or_port, relay.fingerprint, prior_fingerprints[relay.fingerprint]))
 
       # if we've changed more than ten times in the last ten days then alarm
 
       if len(prior_fingerprints) >= 10:
         alarm_for['%s:%s' % (relay.address, relay.or_port)] = (relay.address, relay.or_port, relay.fingerprint)
 
-  if alarm_for and not is_notification_suppressed(alarm_for.values()):
+  if alarm_for and not is_notification_suppressed(suppressions, alarm_for.values()):
     log.debug("Sending a notification for %i relays..." % len(alarm_for))
     body = EMAIL_BODY
 
@@ -108,61 +110,14 @@ def main():
 
     # register that we've notified for these
 
-    current_time = str(int(time.time()))
-
     for address, or_port, _ in alarm_for.values():
-      last_notified_config.set('%s:%s' % (address, or_port), current_time)
-
-    last_notified_config.save()
-
-  save_fingerprint_changes(fingerprint_changes)
-
-
-def load_fingerprint_changes():
-  """
-  Loads information about prior fingerprint changes we've persisted. This
-  provides a dictionary of the form...
-
-    (address, or_port) => {fingerprint: published_timestamp...}
-  """
-
-  log.debug("Loading fingerprint changes...")
-  config = conf.get_config('fingerprint_changes')
-
-  try:
-    config.load(FINGERPRINT_CHANGES_FILE)
-    fingerprint_changes = {}
-
-    for key in config.keys():
-      address, or_port = key.split(':', 1)
+      suppressions.mark('%s:%s' % (address, or_port), ONE_DAY)
 
-      for value in config.get(key, []):
-        fingerprint, published = value.split(':', 1)
-        fingerprint_changes.setdefault((address, int(or_port)), {})[fingerprint] = float(published)
-
-    log.debug("  information for %i relays found" % len(fingerprint_changes))
-    return fingerprint_changes
-  except IOError as exc:
-    log.debug("  unable to read '%s': %s" % (FINGERPRINT_CHANGES_FILE, exc))
-    return {}
-
-
-def save_fingerprint_changes(fingerprint_changes):
-  log.debug("Saving fingerprint changes for %i relays" % len(fingerprint_changes))
-  config = conf.get_config('fingerprint_changes')
-  config.clear()
-
-  for address, or_port in fingerprint_changes:
-    for fingerprint, published in fingerprint_changes[(address, or_port)].items():
-      config.set('%s:%s' % (address, or_port), '%s:%s' % (fingerprint, published), overwrite = False)
-
-  try:
-    config.save(FINGERPRINT_CHANGES_FILE)
-  except IOError as exc:
-    log.debug("  unable to save '%s': %s" % (FINGERPRINT_CHANGES_FILE, exc))
+  suppressions.commit()
+  store.add_fingerprint_changes(new_fingerprints)
 
 
-def is_notification_suppressed(fingerprint_changes):
+def is_notification_suppressed(suppressions, fingerprint_changes):
   """
   Check to see if we've already notified for all these endpoints today. No
   point in causing too much noise.
@@ -170,11 +125,10 @@ def is_notification_suppressed(fingerprint_changes):
 
   is_all_suppressed = True
   log.debug("Checking if notification should be suppressed...")
-  last_notified_config = conf.get_config('last_notified')
 
   for address, or_port, _ in fingerprint_changes:
     key = '%s:%s' % (address, or_port)
-    suppression_time = ONE_DAY - (int(time.time()) - last_notified_config.get(key, 0))
+    suppression_time = suppressions.remaining(key, ONE_DAY)
 
     if suppression_time < 0:
       log.debug("* notification for %s isn't suppressed" % key)
@@ -0,0 +1,136 @@
+"""
+Running statistics for the number of relays each authority assigns a flag,
+so we can notice when an authority's voting suddenly shifts.
+
+Rather than keeping a history of votes we track an exponentially weighted
+moving average and variance for each (authority, flag) pair. Each run updates
+these in place, so the cost of a run is proportional to the number of
+authorities and flags regardless of how long we've been tracking them.
+"""
+
+import collections
+import datetime
+import math
+import os
+
+import util
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+ALPHA = 2.0 / (24 + 1)  # weight of the newest sample, giving hourly samples about a day's worth of memory
+WARMUP = 24  # samples we need before reporting anomalies
+THRESHOLD = 4.0  # standard deviations from the average that we consider anomalous
+MIN_DEVIATION = 0.01  # floor of the standard deviation, as a ratio of the average
+STALE = datetime.timedelta(days = 7)  # drop statistics that haven't been updated this long
+
+FlagStatistic = collections.namedtuple('FlagStatistic', ['valid_after', 'mean', 'variance', 'samples'])
+Anomaly = collections.namedtuple('Anomaly', ['authority', 'flag', 'count', 'mean', 'zscore'])
+
+log = util.get_logger('flag_trends')
+
+
+class FlagTrends(object):
+  """
+  Moving statistics for the flags assigned by each authority.
+
+  :var str path: file our statistics are persisted to, **None** if they're
+    only kept in memory
+  """
+
+  def __init__(self, path = None):
+    self.path = path
+    self._stats = {}  # {(authority, flag) => FlagStatistic}
+    self._is_dirty = False
+
+    if path and os.path.exists(path):
+      with open(path) as stats_file:
+        for line in stats_file:
+          if line.startswith('#'):
+            continue
+
+          entry = line.split()
+
+          if len(entry) == 6:
+            authority, flag, valid_after, mean, variance, samples = entry
+            self._stats[(authority, flag)] = FlagStatistic(datetime.datetime.strptime(valid_after, DATE_FORMAT), float(mean), float(variance), int(samples))
+          elif entry:
+            log.debug("Skipping malformed flag statistics line: %s" % line.strip())
+
+  def update(self, authority, valid_after, flag_counts):
+    """
+    Adds an authority's vote to our statistics. Votes we've already counted
+    are ignored.
+
+    :param str authority: nickname of the authority that voted
+    :param datetime valid_after: time the vote became valid
+    :param dict flag_counts: mapping of flags to the number of relays that
+      received them
+
+    :returns: **list** of **Anomaly** for flags that deviated from their average
+    """
+
+    anomalies = []
+    flags = set(flag_counts).union([flag for (stat_authority, flag) in self._stats if stat_authority == authority])
+
+    for flag in flags:
+      count = flag_counts.get(flag, 0)
+      stat = self._stats.get((authority, flag))
+
+      if stat is None:
+        self._stats[(authority, flag)] = FlagStatistic(valid_after, float(count), 0.0, 1)
+        self._is_dirty = True
+        continue
+      elif valid_after <= stat.valid_after:
+        continue
+
+      if stat.samples >= WARMUP:
+        deviation = max(math.sqrt(stat.variance), stat.mean * MIN_DEVIATION, 1.0)
+        zscore = (count - stat.mean) / deviation
+
+        if abs(zscore) >= THRESHOLD:
+          anomalies.append(Anomaly(authority, flag, count, stat.mean, zscore))
+
+      difference = count - stat.mean
+      increment = ALPHA * difference
+
+      self._stats[(authority, flag)] = FlagStatistic(
+        valid_after,
+        stat.mean + increment,
+        (1 - ALPHA) * (stat.variance + difference * increment),
+        stat.samples + 1,
+      )
+
+      self._is_dirty = True
+
+    return anomalies
+
+  def prune(self, now):
+    """
+    Drops statistics for authorities and flags we haven't seen in a while.
+
+    :param datetime now: current time
+    """
+
+    for key, stat in list(self._stats.items()):
+      if now - stat.valid_after > STALE:
+        del self._stats[key]
+        self._is_dirty = True
+
+  def save(self):
+    """
+    Persists our statistics if they've changed.
+    """
+
+    if not self.path or not self._is_dirty:
+      return
+
+    lines = ['# authority flag valid_after mean variance samples\n']
+
+    for (authority, flag), stat in sorted(self._stats.items()):
+      lines.append('%s %s %s %0.3f %0.3f %i\n' % (authority, flag, stat.valid_after.strftime(DATE_FORMAT), stat.mean, stat.variance, stat.samples))
+
+    util.atomic_write(self.path, ''.join(lines))
+    self._is_dirty = False
+
+  def __len__(self):
+    return len(self._stats)
@@ -6,39 +6,76 @@
 Checks for outdated versions on the packages wiki...
 
   https://trac.torproject.org/projects/tor/wiki/doc/packages
+
+Pages we download are cached, and only requested again if they might have
+changed. With '--offline' we only use what we have cached, and with
+'--benchmark' we compare how quickly versions are extracted from our cached
+pages.
 """
 
+import codecs
 import collections
+import functools
+import hashlib
+import os
 import re
+import sys
+import threading
 import time
-import urllib2
 
 import util
 
-MAC_VERSION = '\w*<td>([0-9\.]+)</td>'
-DEBIAN_VERSION = '<h1>Source Package: \S+ \(([0-9\.]+).*\)'
-FEDORA_VERSION = '<div class="package-name">([0-9\.]+).*</div>'
-ARCH_LINUX_VERSION = '<title>Arch Linux - \S+ ([0-9\.]+).*</title>'
-AUR_VERSION = '<h2>Package Details: \S+ ([0-9\.]+)-\S+</h2>'
-FREEBSD_VERSION = 'SHA256 \(\S+-([0-9\.]+).tar.[gx]z\)'
-OPENBSD_DIST_VERSION = 'DISTNAME\s*=\s+\S+-([0-9\.]+)'
-OPENBSD_EGG_VERSION = 'MODPY_EGG_VERSION =\s+([0-9\.]+)'
-NETBSD_VERSION = 'CURRENT, <b>Version: </b>([0-9\.]+)[a-z0-9]*,'
+try:
+  from urllib.error import HTTPError
+  from urllib.parse import urlparse
+  from urllib.request import Request, urlopen
+except ImportError:
+  from urllib2 import HTTPError, Request, urlopen
+  from urlparse import urlparse
+
+# Patterns are matched a line at a time as pages download, with the first
+# group being the version.
+
+MAC_VERSION = re.compile(r'<td>([0-9\.]+)</td>')
+DEBIAN_VERSION = re.compile(r'<h1>Source Package: \S+ \(([0-9\.]+).*\)')
+FEDORA_VERSION = re.compile(r'<div class="package-name">([0-9\.]+).*</div>')
+ARCH_LINUX_VERSION = re.compile(r'<title>Arch Linux - \S+ ([0-9\.]+).*</title>')
+AUR_VERSION = re.compile(r'<h2>Package Details: \S+ ([0-9\.]+)-\S+</h2>')
+FREEBSD_VERSION = re.compile(r'SHA256 \(\S+-([0-9\.]+).tar.[gx]z\)')
+OPENBSD_DIST_VERSION = re.compile(r'DISTNAME\s*=\s+\S+-([0-9\.]+)')
+OPENBSD_EGG_VERSION = re.compile(r'MODPY_EGG_VERSION =\s+([0-9\.]+)')
+NETBSD_VERSION = re.compile(r'CURRENT, <b>Version: </b>([0-9\.]+)[a-z0-9]*,')
+GENTOO_VERSION = re.compile(r'.ebuild">([0-9\.]+)(?:-r[0-9]+)?</a>')
+WIKI_VERSION = re.compile(r'<b>Version:</b> <a href=".*">(.*)</a>')
 
 COLUMN = '| %-10s | %-10s | %-10s | %-50s |'
 DIV = '+%s+%s+%s+%s+' % ('-' * 12, '-' * 12, '-' * 12, '-' * 52)
 TRAC_URL = 'https://trac.torproject.org/projects/tor/wiki/doc/packages'
 
+FETCH_ATTEMPTS = 3  # times we'll try to download a page
+FETCH_TIMEOUT = 5  # seconds a single download can take
+FETCH_DEADLINE = 60  # seconds we'll spend downloading pages altogether
+MAX_WORKERS = 16  # pages we'll download at once
+MAX_PER_HOST = 2  # pages we'll download at once from any one site
+READ_SIZE = 16 * 1024  # bytes we read from a page at a time
+BENCHMARK_ROUNDS = 20  # times we extract from each page when benchmarking
+
+CACHE_DIR = util.get_path('data', 'http_cache')
+CACHE_FRESHNESS = 6 * 60 * 60  # seconds we use a cached page without asking if it has changed
+CACHE_VERSION = 2  # bumped when our cache entries change, earlier entries are refetched
+OFFLINE = False  # only use cached pages, set by the '--offline' argument
+
 Package = collections.namedtuple('Package', ['platform', 'url', 'regex'])
+CachedPage = collections.namedtuple('CachedPage', ['url', 'fetched', 'etag', 'last_modified', 'path'])
 
 PACKAGES = [
   ('tor', [
     Package('mac', 'https://formulae.brew.sh/formula/tor', MAC_VERSION),
     Package('debian', 'https://packages.debian.org/source/sid/tor', DEBIAN_VERSION),
     Package('fedora', 'https://apps.fedoraproject.org/packages/tor', FEDORA_VERSION),
-    Package('gentoo', 'https://packages.gentoo.org/packages/net-vpn/tor', None),
+    Package('gentoo', 'https://packages.gentoo.org/packages/net-vpn/tor', GENTOO_VERSION),
     Package('archlinux', 'https://www.archlinux.org/packages/community/x86_64/tor/', ARCH_LINUX_VERSION),
-    Package('slackware', 'https://slackbuilds.org/repository/14.2/network/tor/', 'tor-([0-9\.]+).tar.gz'),
+    Package('slackware', 'https://slackbuilds.org/repository/14.2/network/tor/', re.compile(r'tor-([0-9\.]+).tar.gz')),
     Package('freebsd', 'https://www.freshports.org/security/tor/', FREEBSD_VERSION),
     Package('openbsd', 'https://cvsweb.openbsd.org/cgi-bin/cvsweb/ports/net/tor/Makefile?rev=HEAD&content-type=text/x-cvsweb-markup', OPENBSD_DIST_VERSION),
     Package('netbsd', 'http://pkgsrc.se/net/tor', NETBSD_VERSION),
@@ -47,9 +84,9 @@ PACKAGES = [
     Package('mac', 'https://formulae.brew.sh/formula/nyx', MAC_VERSION),
     Package('debian', 'https://packages.debian.org/source/sid/nyx', DEBIAN_VERSION),
     Package('fedora', 'https://apps.fedoraproject.org/packages/nyx', FEDORA_VERSION),
-    Package('gentoo', 'https://packages.gentoo.org/packages/net-misc/nyx', None),
+    Package('gentoo', 'https://packages.gentoo.org/packages/net-misc/nyx', GENTOO_VERSION),
     Package('archlinux', 'https://www.archlinux.org/packages/community/any/nyx/', ARCH_LINUX_VERSION),
-    Package('slackware', 'https://slackbuilds.org/repository/14.2/python/nyx/', 'nyx-([0-9\.]+).tar.gz'),
+    Package('slackware', 'https://slackbuilds.org/repository/14.2/python/nyx/', re.compile(r'nyx-([0-9\.]+).tar.gz')),
     Package('freebsd', 'https://www.freshports.org/security/nyx/', FREEBSD_VERSION),
     Package('openbsd', 'https://cvsweb.openbsd.org/cgi-bin/cvsweb/ports/net/nyx/Makefile?rev=HEAD&content-type=text/x-cvsweb-markup', OPENBSD_EGG_VERSION),
     Package('netbsd', 'http://pkgsrc.se/net/nyx', NETBSD_VERSION),
@@ -57,18 +94,18 @@ PACKAGES = [
   ('stem', [
     Package('debian', 'https://packages.debian.org/source/sid/python-stem', DEBIAN_VERSION),
     Package('fedora', 'https://apps.fedoraproject.org/packages/python-stem', FEDORA_VERSION),
-    Package('gentoo', 'https://packages.gentoo.org/packages/net-libs/stem', None),
+    Package('gentoo', 'https://packages.gentoo.org/packages/net-libs/stem', GENTOO_VERSION),
     Package('archlinux', 'https://www.archlinux.org/packages/community/any/python-stem/', ARCH_LINUX_VERSION),
-    Package('slackware', 'https://slackbuilds.org/repository/14.2/python/stem/', 'stem-([0-9\.]+).tar.gz'),
+    Package('slackware', 'https://slackbuilds.org/repository/14.2/python/stem/', re.compile(r'stem-([0-9\.]+).tar.gz')),
     Package('freebsd', 'https://www.freshports.org/security/py-stem/', FREEBSD_VERSION),
     Package('openbsd', 'https://cvsweb.openbsd.org/cgi-bin/cvsweb/ports/net/py-stem/Makefile?rev=HEAD&content-type=text/x-cvsweb-markup', OPENBSD_EGG_VERSION),
     Package('netbsd', 'http://pkgsrc.se/net/py-stem', NETBSD_VERSION),
   ]),
   ('txtorcon', [
     Package('debian', 'https://packages.debian.org/source/sid/txtorcon', DEBIAN_VERSION),
-    Package('gentoo', 'https://packages.gentoo.org/packages/dev-python/txtorcon', None),
+    Package('gentoo', 'https://packages.gentoo.org/packages/dev-python/txtorcon', GENTOO_VERSION),
     Package('archlinux', 'https://aur.archlinux.org/packages/python-txtorcon/', AUR_VERSION),
-    Package('slackware', 'https://slackbuilds.org/repository/14.2/python/txtorcon/', 'txtorcon-([0-9\.]+).tar.gz'),
+    Package('slackware', 'https://slackbuilds.org/repository/14.2/python/txtorcon/', re.compile(r'txtorcon-([0-9\.]+).tar.gz')),
     Package('freebsd', 'https://www.freshports.org/security/py-txtorcon/', FREEBSD_VERSION),
     Package('netbsd', 'http://pkgsrc.se/net/py-txtorcon', NETBSD_VERSION),
   ]),
@@ -76,9 +113,9 @@ PACKAGES = [
     Package('mac', 'https://formulae.brew.sh/formula/torsocks', MAC_VERSION),
     Package('debian', 'https://packages.debian.org/source/sid/torsocks', DEBIAN_VERSION),
     Package('fedora', 'https://apps.fedoraproject.org/packages/torsocks', FEDORA_VERSION),
-    Package('gentoo', 'https://packages.gentoo.org/packages/net-proxy/torsocks', None),
+    Package('gentoo', 'https://packages.gentoo.org/packages/net-proxy/torsocks', GENTOO_VERSION),
     Package('archlinux', 'https://www.archlinux.org/packages/community/x86_64/torsocks/', ARCH_LINUX_VERSION),
-    Package('slackware', 'https://slackbuilds.org/repository/14.2/network/torsocks/', 'torsocks \(([0-9\.]+)\)    </h2>'),
+    Package('slackware', 'https://slackbuilds.org/repository/14.2/network/torsocks/', re.compile(r'torsocks \(([0-9\.]+)\)    </h2>')),
     Package('freebsd', 'https://www.freshports.org/net/torsocks/', FREEBSD_VERSION),
     Package('openbsd', 'https://cvsweb.openbsd.org/cgi-bin/cvsweb/ports/net/torsocks/Makefile?rev=HEAD&content-type=text/x-cvsweb-markup', OPENBSD_DIST_VERSION),
     Package('netbsd', 'http://pkgsrc.se/net/torsocks', NETBSD_VERSION),
@@ -92,18 +129,339 @@ PACKAGES = [
 log = util.get_logger('package_versions')
 
 
-def fetch_url(url):
-  for i in range(3):
-    try:
-      return urllib2.urlopen(url, timeout = 5).read()
-    except Exception as exc:
-      if i < 2:
-        time.sleep(2 ** i)
-      else:
-        raise IOError(str(exc))
+def fetch_url(url, timeout = FETCH_TIMEOUT, extract = None):
+  """
+  Provides the content of a page, from our cache if it's recent or the site
+  tells us it's unchanged.
+
+  If given an extractor we stop parsing once it has what it needs. The rest
+  of the page is still downloaded so we cache all of it, since our cache
+  entry is revalidated with the page's ETag and Last-Modified headers and
+  needs to be the page they describe.
+
+  :param str url: page to download
+  :param int timeout: seconds the download can take
+  :param functor extract: reads the page's content from an iterator of
+    **str** chunks, providing what we want from it
+
+  :returns: result of our extractor, or **str** with the page's content if we
+    weren't given one
+
+  :raises: **IOError** if unable to download the page, or we're offline and
+    it isn't cached
+  """
+
+  if extract is None:
+    extract = ''.join
+
+  cached = get_cached_page(url)
+
+  if cached and (OFFLINE or time.time() - cached.fetched < CACHE_FRESHNESS):
+    return _read_cached_body(cached, extract)
+  elif OFFLINE:
+    raise IOError('%s is not cached' % url)
+
+  request = Request(url)
+
+  if cached and cached.etag:
+    request.add_header('If-None-Match', cached.etag)
+
+  if cached and cached.last_modified:
+    request.add_header('If-Modified-Since', cached.last_modified)
+
+  try:
+    response = urlopen(request, timeout = timeout)
+  except HTTPError as exc:
+    if exc.code == 304 and cached:
+      cache_page(url, None, cached.etag, cached.last_modified)  # unchanged, refresh when we last checked
+      return _read_cached_body(cached, extract)
+
+    raise
+
+  received = []
+  result = extract(_read_chunks(response, received))
+
+  while True:
+    data = response.read(READ_SIZE)  # remainder our extractor didn't need
+
+    if not data:
+      break
+
+    received.append(data)
+
+  cache_page(url, b''.join(received), response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+  return result
+
+
+def get_cached_page(url):
+  """
+  Provides our cache entry for a page.
+
+  :param str url: page to look up
+
+  :returns: **CachedPage** for the page, **None** if it isn't cached
+  """
+
+  path = _cache_path(url)
+  attr = {}
+
+  if not os.path.exists(path) or not os.path.exists(path + '.body'):
+    return None
+
+  try:
+    with open(path) as cache_file:
+      for line in cache_file:
+        if ' ' in line:
+          key, value = line.rstrip('\n').split(' ', 1)
+          attr[key] = value
+
+    if attr.get('url') != url:
+      return None  # hash collision
+    elif attr.get('version') != str(CACHE_VERSION):
+      return None  # earlier entries could be a partial page
+
+    return CachedPage(url, float(attr['fetched']), attr.get('etag'), attr.get('last-modified'), path + '.body')
+  except (IOError, KeyError, ValueError) as exc:
+    log.debug('Unable to read our cache entry for %s: %s' % (url, exc))
+    return None
+
+
+def cache_page(url, content, etag, last_modified):
+  """
+  Saves a page to our cache.
+
+  :param str url: page we downloaded
+  :param bytes content: content of the page, **None** to keep what we have
+  :param str etag: ETag header of the response
+  :param str last_modified: Last-Modified header of the response
+  """
+
+  path = _cache_path(url)
+  lines = ['url %s' % url, 'version %i' % CACHE_VERSION, 'fetched %i' % time.time()]
+
+  if etag:
+    lines.append('etag %s' % etag)
+
+  if last_modified:
+    lines.append('last-modified %s' % last_modified)
+
+  try:
+    if content is not None:
+      util.atomic_write(path + '.body', content)
+
+    util.atomic_write(path, '\n'.join(lines) + '\n')
+  except (IOError, OSError) as exc:
+    log.debug('Unable to cache %s: %s' % (url, exc))
+
+
+def _cache_path(url):
+  return os.path.join(CACHE_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def _read_cached_body(cached, extract):
+  with open(cached.path, 'rb') as body_file:
+    return extract(_read_chunks(body_file))
+
+
+def _read_chunks(source, received = None):
+  """
+  Incrementally reads and decodes a file or http response.
+
+  :param file source: what we're reading from
+  :param list received: appended with the raw bytes we read
+
+  :returns: iterator for **str** chunks of content
+  """
+
+  decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+  while True:
+    data = source.read(READ_SIZE)
+
+    if received is not None and data:
+      received.append(data)
+
+    chunk = decoder.decode(data, final = not data)
+
+    if chunk:
+      yield chunk
+
+    if not data:
+      break
+
+
+def scan_lines(pattern, chunks):
+  """
+  Matches a pattern against content as it arrives. Chunks are searched up
+  through their last complete line, so matches never straddle a chunk.
+
+  :param re.Pattern pattern: pattern to search for
+  :param iterator chunks: **str** chunks of content
+
+  :returns: iterator for the **re.Match** of our pattern
+  """
+
+  pending = ''
+
+  for chunk in chunks:
+    pending += chunk
+    end = pending.rfind('\n') + 1
+
+    if end:
+      for match in pattern.finditer(pending, 0, end):
+        yield match
+
+      pending = pending[end:]
+
+  for match in pattern.finditer(pending):
+    yield match
+
+
+def first_version(pattern, chunks):
+  """
+  Provides the first version our pattern matches, reading no further.
 
+  :returns: **str** with the version, **None** if not found
+  """
 
-def wiki_package_versions():
+  for match in scan_lines(pattern, chunks):
+    return match.group(1)
+
+  return None
+
+
+def highest_version(pattern, chunks):
+  """
+  Provides the highest version our pattern matches. This is for platforms
+  like gentoo that list every version they have.
+
+  :returns: **str** with the version, **None** if not found
+  """
+
+  versions = set([match.group(1) for match in scan_lines(pattern, chunks)])
+  return max(versions, key = version_tuple) if versions else None
+
+
+def all_versions(pattern, chunks):
+  """
+  Provides every version our pattern matches, in order.
+
+  :returns: **list** of **str** versions
+  """
+
+  return [match.group(1) for match in scan_lines(pattern, chunks)]
+
+
+def version_tuple(version):
+  """
+  Converts a version into a tuple so versions are compared by their numeric
+  components, such that '0.4.10' is newer than '0.4.9'.
+
+  :param str version: version to convert
+
+  :returns: **tuple** of **int** for the version's components
+  """
+
+  return tuple([int(component) for component in version.split('.') if component.isdigit()])
+
+
+def fetch_urls(pages, deadline = FETCH_DEADLINE):
+  """
+  Downloads pages concurrently. Sites are limited in how many of our
+  connections they have at once, and failed downloads are retried with
+  exponential backoff. Rather than sleeping, retries are scheduled so other
+  pages can download in the meantime.
+
+  :param list pages: (url, extractor) tuples for the pages to download, see
+    fetch_url()
+  :param int deadline: seconds until we give up on anything unfinished
+
+  :returns: **dict** mapping urls to what we extracted from them, or an
+    **IOError** if we were unable to download it
+  """
+
+  extractors = collections.OrderedDict(pages)
+  urls = list(extractors.keys())
+  end_time = time.time() + deadline
+  schedule = [(0, index, url, 1) for index, url in enumerate(urls)]  # (start at, order, url, attempt) tuples
+  active = {}  # {host => connections we have open to it}
+  results = {}
+  cond = threading.Condition()
+
+  def next_task():
+    # Provides the first task that's ready to start on a site with spare
+    # connections, or the time until one might be.
+
+    now = time.time()
+
+    for task in sorted(schedule):
+      start_at, _, url, _ = task
+
+      if start_at > now:
+        return None, start_at - now
+      elif active.get(urlparse(url).netloc, 0) < MAX_PER_HOST:
+        schedule.remove(task)
+        return task, None
+
+    return None, None
+
+  def worker():
+    while True:
+      with cond:
+        while True:
+          if len(results) == len(urls) or time.time() >= end_time:
+            return
+
+          task, wait = next_task()
+
+          if task:
+            break
+          elif wait is None and not schedule:
+            return  # everything left is being downloaded by other workers
+
+          cond.wait(min(wait or end_time - time.time(), end_time - time.time()))
+
+        _, order, url, attempt = task
+        host = urlparse(url).netloc
+        active[host] = active.get(host, 0) + 1
+
+      try:
+        content, error = fetch_url(url, max(0.1, min(FETCH_TIMEOUT, end_time - time.time())), extractors[url]), None
+      except Exception as exc:
+        content, error = None, exc
+
+      with cond:
+        active[host] -= 1
+
+        if error is None:
+          results[url] = content
+        elif attempt < FETCH_ATTEMPTS and not OFFLINE and time.time() + 2 ** (attempt - 1) < end_time:
+          log.debug('Unable to download %s, retrying (%s)' % (url, error))
+          schedule.append((time.time() + 2 ** (attempt - 1), order, url, attempt + 1))
+        else:
+          results[url] = IOError(str(error))
+
+        cond.notify_all()
+
+  workers = [threading.Thread(target = worker) for _ in range(min(MAX_WORKERS, len(urls)))]
+
+  for thread in workers:
+    thread.daemon = True
+    thread.start()
+
+  with cond:
+    while len(results) < len(urls) and time.time() < end_time:
+      cond.wait(end_time - time.time())
+
+    for url in urls:
+      if url not in results:
+        results[url] = IOError('unable to download within %i seconds' % deadline)
+
+    return dict(results)
+
+
+def wiki_package_versions(version_entries):
   # Provides versions present on the wiki of the form...
   #
   #   {project => {platform => version}}
@@ -112,16 +470,8 @@ def wiki_package_versions():
   # gonna be very, very brittle. That's fine though - this is just an effort
   # saving measure for me anyway. ;P
 
-  request = fetch_url(TRAC_URL)
-  version_entries = []
   expected_count = sum([len(packages) for project, packages in PACKAGES])
 
-  for line in request.splitlines():
-    m = re.search('<b>Version:</b> <a href=".*">(.*)</a>', line)
-
-    if m:
-      version_entries.append(m.group(1))
-
   if len(version_entries) != expected_count:
     raise IOError('Table on %s no longer matches what this daemon expects (had %i entries)' % (TRAC_URL, len(version_entries)))
 
@@ -135,23 +485,14 @@ def wiki_package_versions():
   return result
 
 
-def gentoo_version(request):
+def version_extractor(package):
   # Unlike other platforms gentoo lists all package versions, so we
   # need to figure out what's the latest.
 
-  highest_version, highest_version_int = None, 0
-
-  for version in set(re.findall('.ebuild">([0-9\.]+)(?:-r[0-9]+)?</a>', request)):
-    version_int = 0
-
-    for section in version.split('.'):
-      version_int = (version_int * 10) + int(section)
-
-    if version_int > highest_version_int:
-      highest_version = version
-      highest_version_int = version_int
-
-  return highest_version
+  if package.platform == 'gentoo':
+    return functools.partial(highest_version, package.regex)
+  else:
+    return functools.partial(first_version, package.regex)
 
 
 def email_content():
@@ -159,8 +500,16 @@ def email_content():
   lines.append(DIV)
   lines.append(COLUMN % ('Project', 'Platform', 'Version', 'Status'))
 
+  # Everything is downloaded upfront, so the report takes about as long as
+  # our slowest page.
+
+  pages = fetch_urls([(TRAC_URL, functools.partial(all_versions, WIKI_VERSION))] + [(package.url, version_extractor(package)) for project, packages in PACKAGES for package in packages])
+
   try:
-    wiki_versions = wiki_package_versions()
+    if isinstance(pages[TRAC_URL], IOError):
+      raise pages[TRAC_URL]
+
+    wiki_versions = wiki_package_versions(pages[TRAC_URL])
   except IOError as exc:
     return str(exc), True
 
@@ -176,13 +525,10 @@ def email_content():
         return 'Failed to get wiki version for %s on %s' % (project, package.platform), True
 
       try:
-        request = fetch_url(package.url)
+        current_version = pages[package.url]
 
-        if package.platform == 'gentoo':
-          current_version = gentoo_version(request)
-        else:
-          match = re.search(package.regex, request)
-          current_version = match.group(1) if match else None
+        if isinstance(current_version, IOError):
+          raise current_version
 
         if not current_version:
           msg = 'unable to determine current version'
@@ -207,7 +553,56 @@ def email_content():
   return '\n'.join(lines), has_issue
 
 
+def benchmark():
+  """
+  Compares extracting versions by reading pages into memory and searching
+  them in full with reading our cached pages a chunk at a time, reporting
+  the time and peak memory each takes.
+  """
+
+  import tracemalloc  # deferred, only needed when benchmarking
+
+  print('%-70s %12s %12s %12s %12s %12s' % ('Page', 'Size (KB)', 'Full (ms)', 'Full (KB)', 'Stream (ms)', 'Stream (KB)'))
+
+  for project, packages in PACKAGES:
+    for package in packages:
+      cached = get_cached_page(package.url)
+
+      if not cached:
+        print('%-70s not cached' % package.url[:70])
+        continue
+
+      def full_read():
+        with open(cached.path, 'rb') as body_file:
+          content = body_file.read().decode('utf-8', 'replace')
+
+        return package.regex.findall(content) if package.platform == 'gentoo' else package.regex.search(content)
+
+      results = [os.path.getsize(cached.path) / 1024.0]
+
+      for func in (full_read, functools.partial(_read_cached_body, cached, version_extractor(package))):
+        tracemalloc.start()
+        start = time.time()
+
+        for _ in range(BENCHMARK_ROUNDS):
+          func()
+
+        runtime = (time.time() - start) / BENCHMARK_ROUNDS
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results += [runtime * 1000, peak / 1024.0]
+
+      print('%-70s %12.1f %12.2f %12.1f %12.2f %12.1f' % tuple([package.url[:70]] + results))
+
+
 if __name__ == '__main__':
+  OFFLINE = '--offline' in sys.argv[1:]
+
+  if '--benchmark' in sys.argv[1:]:
+    benchmark()
+    sys.exit()
+
   content, has_issue = email_content()
 
   if has_issue:
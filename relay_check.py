@@ -3,38 +3,286 @@
 # See LICENSE for licensing information
 
 """
-Health checks for your relay. This provides a simple email notification when
-your relay becomes unavailable.
+Health checks for your relays. This provides a simple email notification when
+your relays become unavailable.
+
+Relays to check are listed in data/relay_check.cfg, or if that has none we
+check the relay below. Relays are checked concurrently and problems with any
+of them are reported in a single email.
+
+We remember each relay's health between runs, and only notify when a relay
+goes down or comes back. A relay must fail (or succeed) several checks in a
+row before we consider it to have changed, so a flapping relay doesn't flood
+us with email. Healthy relays are checked every so often, and those that are
+down with an exponential backoff.
 """
 
-import smtplib
+import collections
+import datetime
+import functools
+import os
+import time
 import traceback
 
-import stem
-import stem.descriptor.remote
-
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import util
 
 RELAY_ADDRESS = '208.113.135.162'
 RELAY_OR_PORT = 1443
 RELAY_NAME = 'caersidi'
 RELAY_FINGERPRINT = '3BB34C63072D9D10E836EE42968713F7B9325F66'
 
+RELAYS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'relay_check.cfg')
+HEALTH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'relay_check_health')
+RELAY_TIMEOUT = 30  # seconds we'll wait for a relay's descriptor
+MAX_CONCURRENT_CHECKS = 32  # relays we'll contact at once
+
+FAILURE_THRESHOLD = 3  # failed checks in a row before we consider a relay down
+RECOVERY_THRESHOLD = 2  # successful checks in a row before we consider a relay up
+HEALTHY_INTERVAL = 15 * 60  # seconds between checks of a healthy relay
+RETRY_INTERVAL = 5 * 60  # seconds before our first retry of a relay that's down
+MAX_RETRY_INTERVAL = 4 * 60 * 60  # longest we'll wait before checking a relay that's down
+SCHEDULE_SLACK = 60  # seconds early a check can run, to accommodate cron jitter
+
 EMAIL_ADDRESS = 'atagar@torproject.org'
-RELAY_LINK = 'https://metrics.torproject.org/rs.html#details/%s' % RELAY_FINGERPRINT
+RELAY_LINK = 'https://metrics.torproject.org/rs.html#details/%s'
+
+Relay = collections.namedtuple('Relay', ['name', 'address', 'or_port', 'fingerprint'])
+
+UP, DOWN = 'up', 'down'
+
+
+class RelayHealth(object):
+  """
+  What we know about a relay from our prior checks.
+
+  :var str state: **UP** or **DOWN**
+  :var float changed: unix timestamp when our state last changed
+  :var float last_seen: unix timestamp when we last got its descriptor
+  :var int failures: checks in a row that have failed
+  :var int successes: checks in a row that have succeeded
+  :var float next_check: unix timestamp when we should check it next
+  :var str digest: digest of the last descriptor it provided
+  :var int uptime: uptime its last descriptor reported
+  :var int bandwidth: observed bandwidth its last descriptor reported
+  :var str problem: what went wrong with our last check, if anything
+  """
+
+  def __init__(self, state = UP, changed = 0, last_seen = 0, failures = 0, successes = 0, next_check = 0, digest = None, uptime = None, bandwidth = None):
+    self.state = state
+    self.changed = changed
+    self.last_seen = last_seen
+    self.failures = failures
+    self.successes = successes
+    self.next_check = next_check
+    self.digest = digest
+    self.uptime = uptime
+    self.bandwidth = bandwidth
+    self.problem = None
+
+  def record(self, desc, problem, now):
+    """
+    Updates our health with the result of a check.
+
+    :param stem.descriptor.server_descriptor.RelayDescriptor desc: descriptor
+      the relay provided, if any
+    :param str problem: description of what went wrong, **None** if the
+      check succeeded
+    :param float now: unix timestamp of the check
+
+    :returns: **UP** or **DOWN** if this changed the relay's state, **None**
+      otherwise
+    """
+
+    transition = None
+    self.problem = problem
+
+    if problem is None:
+      self.failures, self.successes = 0, self.successes + 1
+      self.last_seen = now
+      self.digest, self.uptime, self.bandwidth = desc.digest(), desc.uptime, desc.observed_bandwidth
+
+      if self.state == DOWN and self.successes >= RECOVERY_THRESHOLD:
+        self.state, self.changed, transition = UP, now, UP
+
+      self.next_check = now + (HEALTHY_INTERVAL if self.state == UP else 0)
+    else:
+      self.failures, self.successes = self.failures + 1, 0
+
+      if self.state == UP and self.failures >= FAILURE_THRESHOLD:
+        self.state, self.changed, transition = DOWN, now, DOWN
+
+      if self.state == UP:
+        self.next_check = now  # suspect, check again next run
+      else:
+        self.next_check = now + min(MAX_RETRY_INTERVAL, RETRY_INTERVAL * 2 ** (self.failures - FAILURE_THRESHOLD))
+
+    return transition
 
 
 def main():
+  if not util.acquire_run_lock('relay_check'):
+    return  # our previous run is still checking relays
+
+  relays = load_relays()
+  health = load_health()
+  now = time.time()
+
+  due = [relay for relay in relays if health.setdefault(relay.name, RelayHealth()).next_check <= now + SCHEDULE_SLACK]
+  tasks = [(relay, functools.partial(check_relay, relay)) for relay in due]
+  results = util.run_in_threads(tasks, max_workers = MAX_CONCURRENT_CHECKS, timeout = RELAY_TIMEOUT + 30)
+  notices = []  # (subject, description) tuples
+
+  for relay in due:
+    if relay not in results:
+      desc, problem = None, 'Health check of %s (%s) did not finish' % (relay.name, RELAY_LINK % relay.fingerprint)
+    else:
+      result, exc = results[relay]
+
+      if exc:
+        desc, problem = None, 'Unable to check the health of %s (%s):\n\n%s' % (relay.name, RELAY_LINK % relay.fingerprint, exc)
+      else:
+        desc, problem = result
+
+    relay_health = health[relay.name]
+    last_changed = relay_health.changed
+    transition = relay_health.record(desc, problem, now)
+
+    if transition == DOWN:
+      notices.append(('Unable to reach %s' % relay.name, '%s\n\nLast seen: %s' % (problem, _format_time(relay_health.last_seen))))
+    elif transition == UP:
+      notices.append(('%s is reachable again' % relay.name, '%s (%s) is reachable again after being down for %s.' % (relay.name, RELAY_LINK % relay.fingerprint, datetime.timedelta(seconds = int(now - last_changed)))))
+
+  save_health(dict([(relay.name, health[relay.name]) for relay in relays]))
+
+  if len(notices) == 1:
+    email(*notices[0])
+  elif notices:
+    email('Health of %i relays changed' % len(notices), '\n\n'.join([body for subject, body in notices]))
+
+
+def load_relays():
+  """
+  Provides the relays we should check. These are listed in our config under
+  their nickname, of the form...
+
+    caersidi.address 208.113.135.162
+    caersidi.or_port 1443
+    caersidi.fingerprint 3BB34C63072D9D10E836EE42968713F7B9325F66
+
+  :returns: **list** of **Relay** to check
+
+  :raises: **ValueError** if our config is malformed
+  """
+
+  relays = []
+
+  if os.path.exists(RELAYS_PATH):
+    import stem.util.conf  # deferred, stem is costly to import
+    import stem.util.tor_tools
+
+    config = stem.util.conf.get_config('relay_check')
+    config.load(RELAYS_PATH)
+
+    for name in sorted(set([key.split('.')[0] for key in config.keys()])):
+      address = config.get('%s.address' % name, None)
+      or_port = config.get('%s.or_port' % name, None)
+      fingerprint = config.get('%s.fingerprint' % name, None)
+
+      if not address or not or_port or not fingerprint:
+        raise ValueError("%s requires an address, or_port, and fingerprint" % name)
+      elif not or_port.isdigit():
+        raise ValueError("%s has a malformed or_port: %s" % (name, or_port))
+      elif not stem.util.tor_tools.is_valid_fingerprint(fingerprint):
+        raise ValueError("%s has a malformed fingerprint: %s" % (name, fingerprint))
+
+      relays.append(Relay(name, address, int(or_port), fingerprint.upper()))
+
+  if not relays:
+    relays.append(Relay(RELAY_NAME, RELAY_ADDRESS, RELAY_OR_PORT, RELAY_FINGERPRINT))
+
+  return relays
+
+
+def check_relay(relay):
+  """
+  Fetches a relay's descriptor from its ORPort.
+
+  :param Relay relay: relay to check
+
+  :returns: **tuple** of the form (descriptor, problem), where the problem
+    is a **str** describing why the relay is unavailable or provided an
+    unexpected descriptor, or **None** if it's healthy
+  """
+
+  import stem  # deferred, these are costly to import
+  import stem.descriptor.remote
+
   try:
     desc = stem.descriptor.remote.their_server_descriptor(
-      endpoints = [stem.ORPort(RELAY_ADDRESS, RELAY_OR_PORT)],
+      endpoints = [stem.ORPort(relay.address, relay.or_port)],
+      timeout = RELAY_TIMEOUT,
     ).run()[0]
+  except (stem.SocketError, stem.DownloadFailed):
+    return None, "Unable to reach %s (%s):\n\n%s" % (relay.name, RELAY_LINK % relay.fingerprint, traceback.format_exc())
 
-    if desc.nickname != RELAY_NAME:
-      raise ValueError('Unexpected descriptor:\n\n%s' % desc)
-  except stem.SocketError:
-    email('Unable to reach %s' % RELAY_NAME, "Unable to reach %s (%s):\n\n%s" % (RELAY_NAME, RELAY_LINK, traceback.format_exc()))
+  if desc.nickname != relay.name or desc.fingerprint != relay.fingerprint:
+    return desc, 'Unexpected descriptor from %s (%s):\n\n%s' % (relay.name, RELAY_LINK % relay.fingerprint, desc)
+
+  return desc, None
+
+
+def load_health():
+  """
+  Reads what we know about our relays from prior runs.
+
+  :returns: **dict** mapping relay names to their **RelayHealth**
+  """
+
+  health = {}
+
+  if os.path.exists(HEALTH_PATH):
+    with open(HEALTH_PATH) as health_file:
+      for line in health_file:
+        entry = line.split()
+
+        if len(entry) != 10 or line.startswith('#'):
+          continue
+
+        name, state, changed, last_seen, failures, successes, next_check, digest, uptime, bandwidth = entry
+
+        health[name] = RelayHealth(
+          state,
+          float(changed),
+          float(last_seen),
+          int(failures),
+          int(successes),
+          float(next_check),
+          None if digest == '-' else digest,
+          None if uptime == '-' else int(uptime),
+          None if bandwidth == '-' else int(bandwidth),
+        )
+
+  return health
+
+
+def save_health(health):
+  """
+  Persists what we know about our relays for future runs.
+
+  :param dict health: mapping of relay names to their **RelayHealth**
+  """
+
+  lines = ['# name state changed last_seen failures successes next_check digest uptime bandwidth\n']
+
+  for name, entry in sorted(health.items()):
+    optional = ['-' if value is None else str(value) for value in (entry.digest, entry.uptime, entry.bandwidth)]
+    lines.append('%s %s %i %i %i %i %i %s\n' % (name, entry.state, entry.changed, entry.last_seen, entry.failures, entry.successes, entry.next_check, ' '.join(optional)))
+
+  util.atomic_write(HEALTH_PATH, ''.join(lines))
+
+
+def _format_time(timestamp):
+  return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S UTC') if timestamp else 'never'
 
 
 def email(subject, body):
@@ -47,6 +295,11 @@ def email(subject, body):
   :raises: **Exception** if the email fails to be sent
   """
 
+  import smtplib  # deferred, only needed when we notify
+
+  from email.mime.multipart import MIMEMultipart
+  from email.mime.text import MIMEText
+
   msg = MIMEMultipart('alternative')
   msg['Subject'] = subject
   msg['To'] = EMAIL_ADDRESS
@@ -62,4 +315,4 @@ if __name__ == '__main__':
   try:
     main()
   except:
-    email('Health check error', "Unable to check the health of %s (%s):\n\n%s" % (RELAY_NAME, RELAY_LINK, traceback.format_exc()))
+    email('Health check error', "Unable to check the health of our relays:\n\n%s" % traceback.format_exc())
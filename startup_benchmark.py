@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Measures how long each of our scripts takes to import, so their cold start
+stays within budget...
+
+  % python startup_benchmark.py
+
+Each script is imported several times in a fresh interpreter and the fastest
+is kept. Results are recorded as measurements in our state database so we
+can see how they change over time. This exits with a non-zero status if any
+script exceeds its budget.
+"""
+
+import re
+import subprocess
+import sys
+
+import state
+import util
+
+SCRIPTS = (
+  'consensus_health_checker',
+  'descriptor_checker',
+  'fallback_directories',
+  'fingerprint_change_checker',
+  'package_versions',
+  'relay_check',
+  'sybil_checker',
+  'track_relays',
+)
+
+BUDGET = 0.25  # seconds a script may take to import
+ATTEMPTS = 5  # imports of each script, to smooth over noise
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| (\S+)$')
+
+
+def main():
+  results = {}  # {script => seconds, None if it failed to import}
+
+  for script in SCRIPTS:
+    results[script] = measure(script)
+
+    if results[script] is None:
+      print('%-30s unable to import' % script)
+    else:
+      print('%-30s %0.3fs%s' % (script, results[script], ' (over budget)' if results[script] > BUDGET else ''))
+
+  state.get_store().add_measurements([('import_time.%s' % script, seconds) for script, seconds in sorted(results.items())])
+
+  over_budget = [script for script, seconds in results.items() if seconds is not None and seconds > BUDGET]
+
+  if over_budget:
+    print('\n%i scripts exceeded our budget of %0.2fs: %s' % (len(over_budget), BUDGET, ', '.join(over_budget)))
+    sys.exit(1)
+
+
+def measure(script):
+  """
+  Provides the cumulative time it takes to import a script, according to
+  python's '-X importtime' output.
+
+  :param str script: module name of the script
+
+  :returns: **float** for the fastest import in seconds, **None** if it
+    failed to import
+  """
+
+  timings = []
+
+  for _ in range(ATTEMPTS):
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import %s' % script], cwd = util.get_path(), stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    _, stderr = process.communicate()
+
+    if process.returncode != 0:
+      return None
+
+    for line in stderr.decode('utf-8', 'replace').splitlines():
+      match = IMPORT_TIME_LINE.match(line)
+
+      if match and match.group(2) == script:
+        timings.append(int(match.group(1)) / 1000000.0)
+
+  return min(timings) if timings else None
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,389 @@
+"""
+Persistent state shared by our scripts, kept in a single SQLite database.
+
+Our scripts used to each read and rewrite their own files under data/, with
+nothing to stop two of them (or two runs of the same script) from clobbering
+each other. Instead their state is kept in typed tables...
+
+  * fingerprints - relays the sybil checker has seen
+  * fingerprint_changes - fingerprints relays have had at each address
+  * suppressions - when we last notified for something
+  * measurements - timestamped values we track over time
+
+The database is in WAL mode, so readers never block and writers wait on each
+other rather than failing. Scripts only write the rows they changed. The
+first time we're opened the older files are imported and renamed with a
+'.migrated' suffix.
+"""
+
+import contextlib
+import os
+import sqlite3
+import time
+
+import util
+
+STATE_PATH = util.get_path('data', 'state.sqlite')
+SCHEMA_VERSION = 1  # bumped when our tables change
+BUSY_TIMEOUT = 60  # seconds we'll wait for another script to finish writing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+  fingerprint TEXT PRIMARY KEY,
+  first_seen INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS fingerprint_changes (
+  address TEXT NOT NULL,
+  or_port INTEGER NOT NULL,
+  fingerprint TEXT NOT NULL,
+  published REAL NOT NULL,
+  PRIMARY KEY (address, or_port, fingerprint)
+);
+
+CREATE INDEX IF NOT EXISTS fingerprint_changes_by_published ON fingerprint_changes (published);
+
+CREATE TABLE IF NOT EXISTS suppressions (
+  name TEXT NOT NULL,
+  key TEXT NOT NULL,
+  timestamp INTEGER NOT NULL,
+  duration INTEGER,
+  PRIMARY KEY (name, key)
+);
+
+CREATE TABLE IF NOT EXISTS measurements (
+  series TEXT NOT NULL,
+  recorded INTEGER NOT NULL,
+  value REAL
+);
+
+CREATE INDEX IF NOT EXISTS measurements_by_series ON measurements (series, recorded);
+
+CREATE TABLE IF NOT EXISTS properties (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+# Files we import the first time we're opened. Suppressions are named after
+# the file they were in (for instance 'last_notified' for last_notified.cfg).
+
+LEGACY_FINGERPRINTS = util.get_path('data', 'fingerprints')
+LEGACY_FINGERPRINT_CHANGES = util.get_path('data', 'fingerprint_changes')
+LEGACY_STARTUP_TIMES = util.get_path('data', 'startup_times')
+LEGACY_SUPPRESSIONS = ('last_notified', 'fingerprint_change_last_notified', 'track_relays_last_notified')
+
+log = util.get_logger('state')
+
+_STORE = None  # StateStore provided by get_store()
+
+
+def get_store():
+  """
+  Provides the state database of this process, opening it if we haven't yet.
+
+  :returns: **StateStore** for our database
+
+  :raises: **sqlite3.Error** if unable to open the database
+  """
+
+  global _STORE
+
+  if _STORE is None:
+    _STORE = StateStore()
+
+  return _STORE
+
+
+class StateStore(object):
+  """
+  Connection to our state database.
+
+  :var str path: location of our database
+  """
+
+  def __init__(self, path = STATE_PATH):
+    self.path = path
+
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+
+    # we begin our own transactions, so sqlite3 shouldn't implicitly do so
+
+    self._conn = sqlite3.connect(path, timeout = BUSY_TIMEOUT, isolation_level = None)
+    self._conn.execute('PRAGMA journal_mode = WAL')
+    self._conn.execute('PRAGMA synchronous = NORMAL')
+
+    if self._schema_version() < SCHEMA_VERSION:
+      self._initialize()
+
+  def fingerprints(self):
+    """
+    Provides the relay fingerprints we've seen.
+
+    :returns: **set** of fingerprints
+    """
+
+    return set([row[0] for row in self._conn.execute('SELECT fingerprint FROM fingerprints')])
+
+  def fingerprints_updated(self):
+    """
+    Provides when we last added fingerprints.
+
+    :returns: **int** unix timestamp when fingerprints were last added,
+      **None** if they never have been
+    """
+
+    value = self._get_property('fingerprints_updated')
+    return int(value) if value is not None else None
+
+  def add_fingerprints(self, fingerprints):
+    """
+    Records relay fingerprints we've seen. Fingerprints we already have are
+    left alone.
+
+    :param list fingerprints: fingerprints we've seen
+    """
+
+    now = int(time.time())
+
+    with self._transaction():
+      self._conn.executemany('INSERT OR IGNORE INTO fingerprints VALUES (?, ?)', [(fingerprint, now) for fingerprint in fingerprints])
+      self._set_property('fingerprints_updated', now)
+
+  def fingerprint_changes(self):
+    """
+    Provides the fingerprints relays have had. This is a dictionary of the
+    form...
+
+      (address, or_port) => {fingerprint: published_timestamp...}
+
+    :returns: **dict** of relay endpoints to their fingerprints
+    """
+
+    changes = {}
+
+    for address, or_port, fingerprint, published in self._conn.execute('SELECT address, or_port, fingerprint, published FROM fingerprint_changes'):
+      changes.setdefault((address, or_port), {})[fingerprint] = published
+
+    return changes
+
+  def add_fingerprint_changes(self, changes):
+    """
+    Records new fingerprints relays have had.
+
+    :param list changes: (address, or_port, fingerprint, published) tuples
+    """
+
+    with self._transaction():
+      self._conn.executemany('INSERT OR REPLACE INTO fingerprint_changes VALUES (?, ?, ?, ?)', changes)
+
+  def prune_fingerprint_changes(self, before):
+    """
+    Drops fingerprints that were published before the given time.
+
+    :param float before: unix timestamp of the oldest fingerprints we keep
+
+    :returns: **int** for the number of fingerprints dropped
+    """
+
+    with self._transaction():
+      return self._conn.execute('DELETE FROM fingerprint_changes WHERE published < ?', (before,)).rowcount
+
+  def suppressions(self, name):
+    """
+    Provides when we last notified for each key.
+
+    :param str name: name our suppressions are stored under
+
+    :returns: **dict** of keys to (timestamp, duration) tuples, the duration
+      being **None** if unknown
+    """
+
+    query = 'SELECT key, timestamp, duration FROM suppressions WHERE name = ?'
+    return dict([(key, (timestamp, duration)) for key, timestamp, duration in self._conn.execute(query, (name,))])
+
+  def set_suppressions(self, name, entries):
+    """
+    Records when we notified for the given keys.
+
+    :param str name: name our suppressions are stored under
+    :param dict entries: keys to (timestamp, duration) tuples
+    """
+
+    with self._transaction():
+      self._conn.executemany('INSERT OR REPLACE INTO suppressions VALUES (?, ?, ?, ?)', [(name, key, timestamp, duration) for key, (timestamp, duration) in entries.items()])
+
+  def prune_suppressions(self, name, before, default_duration):
+    """
+    Drops suppressions that lapsed before the given time.
+
+    :param str name: name our suppressions are stored under
+    :param int before: unix timestamp of the oldest lapsed suppressions we keep
+    :param int default_duration: duration of suppressions that lack one
+
+    :returns: **int** for the number of suppressions dropped
+    """
+
+    with self._transaction():
+      return self._conn.execute('DELETE FROM suppressions WHERE name = ? AND timestamp + COALESCE(duration, ?) < ?', (name, default_duration, before)).rowcount
+
+  def add_measurements(self, measurements, recorded = None):
+    """
+    Records values for the given series.
+
+    :param list measurements: (series, value) tuples, the value can be
+      **None** if it couldn't be measured
+    :param int recorded: unix timestamp of the measurements, the current time
+      if **None**
+    """
+
+    recorded = int(time.time()) if recorded is None else recorded
+
+    with self._transaction():
+      self._conn.executemany('INSERT INTO measurements VALUES (?, ?, ?)', [(series, recorded, value) for series, value in measurements])
+
+  def measurements(self, series, since = None):
+    """
+    Provides the values we've recorded for a series.
+
+    :param str series: series to provide
+    :param int since: only provide values recorded at or after this unix
+      timestamp
+
+    :returns: **list** of (recorded, value) tuples, oldest first
+    """
+
+    query = 'SELECT recorded, value FROM measurements WHERE series = ? AND recorded >= ? ORDER BY recorded'
+    return list(self._conn.execute(query, (series, since if since is not None else 0)))
+
+  def close(self):
+    self._conn.close()
+
+  @contextlib.contextmanager
+  def _transaction(self):
+    """
+    Performs our writes within an exclusive transaction, waiting for other
+    scripts' writes to finish first.
+    """
+
+    self._conn.execute('BEGIN IMMEDIATE')
+
+    try:
+      yield
+    except:
+      self._conn.execute('ROLLBACK')
+      raise
+
+    self._conn.execute('COMMIT')
+
+  def _schema_version(self):
+    return self._conn.execute('PRAGMA user_version').fetchone()[0]
+
+  def _get_property(self, key):
+    row = self._conn.execute('SELECT value FROM properties WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+  def _set_property(self, key, value):
+    self._conn.execute('INSERT OR REPLACE INTO properties VALUES (?, ?)', (key, str(value)))
+
+  def _initialize(self):
+    """
+    Creates our tables and imports the files we previously kept our state in.
+    """
+
+    migrated = []
+
+    with self._transaction():
+      if self._schema_version() >= SCHEMA_VERSION:
+        return  # another script initialized us while we waited
+
+      for statement in SCHEMA.split(';'):
+        if statement.strip():
+          self._conn.execute(statement)
+
+      if os.path.exists(LEGACY_FINGERPRINTS):
+        self._migrate_fingerprints(LEGACY_FINGERPRINTS)
+        migrated.append(LEGACY_FINGERPRINTS)
+
+      if os.path.exists(LEGACY_FINGERPRINT_CHANGES):
+        self._migrate_fingerprint_changes(LEGACY_FINGERPRINT_CHANGES)
+        migrated.append(LEGACY_FINGERPRINT_CHANGES)
+
+      if os.path.exists(LEGACY_STARTUP_TIMES):
+        self._migrate_startup_times(LEGACY_STARTUP_TIMES)
+        migrated.append(LEGACY_STARTUP_TIMES)
+
+      for name in LEGACY_SUPPRESSIONS:
+        path = util.get_path('data', '%s.cfg' % name)
+
+        if os.path.exists(path):
+          self._migrate_suppressions(name, path)
+          migrated.append(path)
+
+      self._conn.execute('PRAGMA user_version = %i' % SCHEMA_VERSION)
+
+    for path in migrated:
+      os.rename(path, path + '.migrated')
+      log.info("Migrated '%s' into our state database" % path)
+
+  def _migrate_fingerprints(self, path):
+    with open(path) as fingerprint_file:
+      fingerprints = [line.strip() for line in fingerprint_file if line.strip()]
+
+    updated = int(os.stat(path).st_mtime)
+    self._conn.executemany('INSERT OR IGNORE INTO fingerprints VALUES (?, ?)', [(fingerprint, updated) for fingerprint in fingerprints])
+    self._set_property('fingerprints_updated', updated)
+
+  def _migrate_fingerprint_changes(self, path):
+    # stem config lines of the form 'address:or_port fingerprint:published'
+
+    changes = []
+
+    with open(path) as changes_file:
+      for line in changes_file:
+        entry = line.split()
+
+        if len(entry) != 2 or line.startswith('#'):
+          continue
+
+        address, or_port = entry[0].rsplit(':', 1)
+        fingerprint, published = entry[1].split(':', 1)
+        changes.append((address, int(or_port), fingerprint, float(published)))
+
+    self._conn.executemany('INSERT OR REPLACE INTO fingerprint_changes VALUES (?, ?, ?, ?)', changes)
+
+  def _migrate_startup_times(self, path):
+    # lines of the form 'timestamp script seconds', seconds being 'failed' if
+    # the script couldn't be imported
+
+    measurements = []
+
+    with open(path) as times_file:
+      for line in times_file:
+        entry = line.split()
+
+        if len(entry) != 3:
+          continue
+
+        recorded = int(time.mktime(time.strptime(entry[0], '%Y-%m-%dT%H:%M:%S')))
+        measurements.append(('import_time.%s' % entry[1], recorded, None if entry[2] == 'failed' else float(entry[2])))
+
+    self._conn.executemany('INSERT INTO measurements VALUES (?, ?, ?)', measurements)
+
+  def _migrate_suppressions(self, name, path):
+    # lines of the form 'key timestamp [duration]'
+
+    entries = []
+
+    with open(path) as suppression_file:
+      for line in suppression_file:
+        entry = line.split()
+
+        if len(entry) < 2 or not entry[1].isdigit():
+          continue
+
+        duration = int(entry[2]) if len(entry) > 2 and entry[2].isdigit() else None
+        entries.append((name, entry[0], int(entry[1]), duration))
+
+    self._conn.executemany('INSERT OR REPLACE INTO suppressions VALUES (?, ?, ?, ?)', entries)
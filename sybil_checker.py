@@ -7,14 +7,12 @@ Simple script that checks to see if there has been a sudden influx of new
 relays. If so then this sends an email notification.
 """
 
-import os
 import time
 import traceback
 
+import state
 import util
 
-from stem.descriptor.remote import DescriptorDownloader
-
 EMAIL_SUBJECT = 'Possible Sybil Attack'
 
 EMAIL_BODY = """\
@@ -29,13 +27,18 @@ RELAY_ENTRY = """\
   Exit Policy: %s
 """
 
-FINGERPRINTS_FILE = util.get_path('data', 'fingerprints')
-
 log = util.get_logger('sybil_checker')
 
 
 def main():
-  prior_fingerprints = load_fingerprints()
+  if not util.acquire_run_lock('sybil_checker'):
+    log.warn("Our previous run is still active, skipping this one.")
+    return
+
+  from stem.descriptor.remote import DescriptorDownloader  # deferred, it's costly to import
+
+  store = state.get_store()
+  prior_fingerprints = store.fingerprints()
   downloader = DescriptorDownloader(timeout = 60, validate = True)
 
   dry_run = False
@@ -44,13 +47,13 @@ def main():
     log.debug("We don't have any existing fingerprints so this will be a dry-run. No notifications will be sent.")
     dry_run = True
   else:
-    last_modified = os.stat(FINGERPRINTS_FILE).st_mtime  # unix timestamp for when it was last modified
+    last_modified = store.fingerprints_updated()  # unix timestamp for when they were last added to
     seconds_ago = int(time.time() - last_modified)
 
-    log.debug("Our fingerprint was last modified at %s (%i seconds ago)." % (time.ctime(last_modified), seconds_ago))
+    log.debug("%i fingerprints found, last updated at %s (%i seconds ago)." % (len(prior_fingerprints), time.ctime(last_modified), seconds_ago))
 
     if seconds_ago > (3 * 60 * 60):
-      log.debug("Fingerprint file was last modified over three hours ago. No notifications will be sent for this run.")
+      log.debug("Fingerprints were last updated over three hours ago. No notifications will be sent for this run.")
       dry_run = True
 
   query = downloader.get_consensus()
@@ -71,7 +74,7 @@ def main():
     log.debug("Sending a notification...")
     send_email([relays[fp] for fp in new_fingerprints])
 
-  save_fingerprints(prior_fingerprints.union(current_fingerprints))
+  store.add_fingerprints(new_fingerprints)
 
 
 def send_email(new_relays):
@@ -98,43 +101,6 @@ def send_email(new_relays):
     log.warn("Unable to send email: %s" % exc)
 
 
-def load_fingerprints():
-  log.debug("Loading fingerprints...")
-
-  if not os.path.exists(FINGERPRINTS_FILE):
-    log.debug("  '%s' doesn't exist" % FINGERPRINTS_FILE)
-    return set()
-
-  try:
-    with open(FINGERPRINTS_FILE) as fingerprint_file:
-      fingerprints = fingerprint_file.read().strip()
-
-      if not fingerprints:
-        log.debug("  '%s' is empty" % FINGERPRINTS_FILE)
-        return set()
-
-      fingerprints = fingerprints.splitlines()
-
-      log.debug("  %i fingerprints found" % len(fingerprints))
-      return set(fingerprints)
-  except Exception as exc:
-    log.debug("  unable to read '%s': %s" % (FINGERPRINTS_FILE, exc))
-    return set()
-
-
-def save_fingerprints(fingerprints):
-  data_dir = util.get_path('data')
-
-  try:
-    if not os.path.exists(data_dir):
-      os.mkdir(data_dir)
-
-    with open(FINGERPRINTS_FILE, 'w') as fingerprint_file:
-      fingerprint_file.write('\n'.join(fingerprints))
-  except Exception as exc:
-    log.debug("Unable to save fingerprints to '%s': %s" % (FINGERPRINTS_FILE, exc))
-
-
 if __name__ == '__main__':
   try:
     main()
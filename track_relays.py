@@ -7,13 +7,13 @@ Notifies if specific relays reappear in the network.
 """
 
 import datetime
+import hashlib
 import os
-import time
+import pickle
 import traceback
 
-import stem.descriptor.remote
-import stem.exit_policy
 import stem.util.conf
+import stem.util.connection
 
 import util
 
@@ -21,6 +21,11 @@ log = util.get_logger('track_relays')
 
 EMAIL_SUBJECT = 'Relays Returned'
 ONE_WEEK = 7 * 24 * 60 * 60
+IPV4_MAPPED = 0xFFFF << 32  # IPv4 addresses are indexed as ::ffff:a.b.c.d
+
+TRACKED_RELAYS_PATH = util.get_path('data', 'tracked_relays.cfg')
+INDEX_CACHE_PATH = util.get_path('data', 'tracked_relays.cache')
+INDEX_CACHE_VERSION = 1
 
 EMAIL_BODY = """\
 The following previously relays flagged as being malicious have returned to the
@@ -60,6 +65,12 @@ class TrackedRelay(object):
     if not self.addresses and not self.fingerprints:
       raise ValueError("We need either a '%s.address' or '%s.fingerprint' to track" % (identifier, identifier))
 
+    for address in self.addresses:
+      try:
+        _parse_address(address)
+      except ValueError as exc:
+        raise ValueError("'%s.address' is malformed: %s" % (identifier, exc))
+
   def __str__(self):
     attr = []
 
@@ -72,115 +83,317 @@ class TrackedRelay(object):
     return '%s (%s)' % (self.identifier, ', '.join(attr))
 
 
-def get_tracked_relays():
+class AddressIndex(object):
   """
-  Provides the relays we're tracking.
+  Lookup table for the IPv4 and IPv6 addresses and ranges we're tracking.
 
-  :returns: **list** of **TrackedRelay** we're tracking
+  Everything is keyed by its integer value within the IPv6 address space (IPv4
+  addresses are IPv4-mapped), so an exact address is simply a /128 prefix.
+  Lookups check each prefix length we have entries for, so they're constant
+  time regardless of how many addresses we track.
+  """
 
-  :raises: **ValueError** if our config file is malformed
+  def __init__(self):
+    self._prefixes = {}  # {prefix length => {masked address => [TrackedRelay]}}
+
+  def add(self, address, relay):
+    """
+    Registers an address or address range for the given relay.
+
+    :param str address: address or range (such as '185.19.80.0/26')
+    :param TrackedRelay relay: relay this address belongs to
+
+    :raises: **ValueError** if the address is malformed
+    """
+
+    value, prefix = _parse_address(address)
+    self._prefixes.setdefault(prefix, {}).setdefault(_mask(value, prefix), []).append(relay)
+
+  def get(self, address):
+    """
+    Provides the relays tracking the given address.
+
+    :param str address: IPv4 or IPv6 address to look up
+
+    :returns: **list** of **TrackedRelay** that match this address
+    """
+
+    try:
+      value, _ = _parse_address(address)
+    except ValueError:
+      log.debug("Unable to look up malformed address: %s" % address)
+      return []
+
+    matches = []
+
+    for prefix, entries in self._prefixes.items():
+      for relay in entries.get(_mask(value, prefix), []):
+        if relay not in matches:
+          matches.append(relay)
+
+    return matches
+
+  def __len__(self):
+    return sum([len(entries) for entries in self._prefixes.values()])
+
+
+def _parse_address(address):
   """
+  Converts an address or range into its integer form within the IPv6 address
+  space.
 
-  config = stem.util.conf.get_config('tracked_relays')
-  config.load(util.get_path('data', 'tracked_relays.cfg'))
+  :param str address: IPv4 or IPv6 address, optionally with a '/bits' suffix
+    (IPv4 ranges may also be given a netmask like '/255.255.255.0')
 
-  results, expired = [], []
+  :returns: **tuple** of the form (address int, prefix length)
 
-  for identifier in set([key.split('.')[0] for key in config.keys()]):
-    relay = TrackedRelay(identifier, config)
+  :raises: **ValueError** if the address is malformed
+  """
 
-    if relay.expires > datetime.datetime.now():
-      results.append(relay)
+  address, prefix = address.split('/', 1) if '/' in address else (address, None)
+  address = address.strip().strip('[]')
+
+  if stem.util.connection.is_valid_ipv4_address(address):
+    value, max_bits, offset = IPV4_MAPPED | stem.util.connection.address_to_int(address), 32, 96
+  elif stem.util.connection.is_valid_ipv6_address(address):
+    value, max_bits, offset = stem.util.connection.address_to_int(address), 128, 0
+  else:
+    raise ValueError("'%s' isn't a valid IPv4 or IPv6 address" % address)
+
+  if prefix is None:
+    bits = max_bits
+  elif prefix.isdigit() and int(prefix) <= max_bits:
+    bits = int(prefix)
+  elif max_bits == 32 and stem.util.connection.is_valid_ipv4_address(prefix):
+    bits = stem.util.connection._get_masked_bits(prefix)
+  else:
+    raise ValueError("'%s' isn't a valid prefix for %s" % (prefix, address))
+
+  return value, offset + bits
+
+
+def _mask(value, prefix):
+  """
+  Zeroes all but the first prefix bits of a 128 bit address.
+  """
+
+  return value >> (128 - prefix) << (128 - prefix)
+
+
+def _advertised_addresses(desc):
+  """
+  Provides all the ORPort endpoints a relay advertises, which includes its
+  IPv4 address and any 'a' lines (usually IPv6).
+
+  :param stem.descriptor.router_status_entry.RouterStatusEntryV3 desc: relay
+
+  :returns: **list** of (address, port) tuples
+  """
+
+  endpoints = [(desc.address, desc.or_port)]
+
+  for address, port, _ in desc.or_addresses:
+    if (address, port) not in endpoints:
+      endpoints.append((address, port))
+
+  return endpoints
+
+
+def _endpoint_label(address, port):
+  return '[%s]:%s' % (address, port) if ':' in address else '%s:%s' % (address, port)
+
+
+class TrackedRelayIndex(object):
+  """
+  Compiled form of our tracked_relays.cfg, which is cached across runs so
+  unchanged configurations needn't be parsed and validated again.
+
+  :var list relays: **TrackedRelay** entries that haven't expired
+  :var list expired: **TrackedRelay** entries that have expired
+  :var AddressIndex addresses: lookup table for tracked addresses and ranges
+  :var dict fingerprints: mapping of tracked fingerprints to their **TrackedRelay**
+  :var datetime next_expiration: when the next of our relays expires
+  :var float mtime: modification time of the config this was compiled from
+  :var str digest: sha256 digest of the config this was compiled from
+  """
+
+  def __init__(self, relays, mtime, digest):
+    now = datetime.datetime.now()
+
+    self.relays = [relay for relay in relays if relay.expires > now]
+    self.expired = [relay for relay in relays if relay.expires <= now]
+    self.addresses = AddressIndex()
+    self.fingerprints = {}
+    self.next_expiration = min([relay.expires for relay in self.relays]) if self.relays else None
+    self.mtime = mtime
+    self.digest = digest
+
+    for relay in self.relays:
+      for address in relay.addresses:
+        self.addresses.add(address, relay)
+
+      for fingerprint in relay.fingerprints:
+        self.fingerprints[fingerprint] = relay
+
+  def is_expired(self):
+    """
+    Checks if any of our relays have expired since we were compiled.
+
+    :returns: **True** if we need to be recompiled, **False** otherwise
+    """
+
+    return self.next_expiration is not None and self.next_expiration <= datetime.datetime.now()
+
+
+def get_tracked_relay_index():
+  """
+  Provides a lookup index for the relays we're tracking. This is loaded from
+  our cache when tracked_relays.cfg hasn't changed, and compiled otherwise.
+
+  :returns: **TrackedRelayIndex** for the relays we're tracking
+
+  :raises: **ValueError** if our config file is malformed
+  """
+
+  config_stat = os.stat(TRACKED_RELAYS_PATH)
+  index = _load_index_cache()
+
+  if index and index.mtime == config_stat.st_mtime and not index.is_expired():
+    log.debug("Using cached index of %i tracked relays" % len(index.relays))
+  else:
+    with open(TRACKED_RELAYS_PATH, 'rb') as config_file:
+      digest = hashlib.sha256(config_file.read()).hexdigest()
+
+    if index and index.digest == digest and not index.is_expired():
+      log.debug("tracked_relays.cfg was touched but unchanged, using cached index")
+      index.mtime = config_stat.st_mtime
     else:
-      expired.append(relay)
+      log.debug("Compiling index of tracked relays")
+      config = stem.util.conf.get_config('tracked_relays')
+      config.clear()
+      config.load(TRACKED_RELAYS_PATH)
 
-  if expired:
+      relays = [TrackedRelay(identifier, config) for identifier in set([key.split('.')[0] for key in config.keys()])]
+      index = TrackedRelayIndex(relays, config_stat.st_mtime, digest)
+
+    _save_index_cache(index)
+
+  if index.expired:
     body = 'The following entries in tracked_relays.cfg have expired...\n\n'
 
-    for relay in expired:
+    for relay in index.expired:
       body += '* %s (%s)\n' % (relay.identifier, relay.expires.strftime('%Y-%m-%d'))
 
     util.send('tracked_relays.cfg entries expired', body = body, to = ['gk@torproject.org'])
 
-  return results
+  return index
 
 
-def main():
-  last_notified_config = stem.util.conf.get_config('last_notified')
-  last_notified_path = util.get_path('data', 'track_relays_last_notified.cfg')
+def get_tracked_relays():
+  """
+  Provides the relays we're tracking.
 
-  if os.path.exists(last_notified_path):
-    last_notified_config.load(last_notified_path)
-  else:
-    last_notified_config._path = last_notified_path
+  :returns: **list** of **TrackedRelay** we're tracking
+
+  :raises: **ValueError** if our config file is malformed
+  """
+
+  return get_tracked_relay_index().relays
+
+
+def _load_index_cache():
+  if not os.path.exists(INDEX_CACHE_PATH):
+    return None
+
+  try:
+    with open(INDEX_CACHE_PATH, 'rb') as cache_file:
+      version, index = pickle.load(cache_file)
+
+    if version == INDEX_CACHE_VERSION:
+      return index
+
+    log.debug("Discarding tracked relay index cache from version %s" % version)
+  except Exception as exc:
+    log.debug("Unable to load tracked relay index cache: %s" % exc)
 
-  # Map addresses and fingerprints to relays for constant time lookups. Address
-  # ranges are handled separately cuz... well, they're a pita.
+  return None
 
-  tracked_addresses = {}
-  tracked_address_ranges = {}
-  tracked_fingerprints = {}
 
-  for relay in get_tracked_relays():
-    for address in relay.addresses:
-      if '/' in address:
-        # It's a total hack, but taking advantage of exit policies where we
-        # already support address ranges.
+def _save_index_cache(index):
+  try:
+    util.atomic_write(INDEX_CACHE_PATH, pickle.dumps((INDEX_CACHE_VERSION, index), protocol = 2))
+  except Exception as exc:
+    log.debug("Unable to save tracked relay index cache: %s" % exc)
+
+
+def main():
+  if not util.acquire_run_lock('track_relays'):
+    log.warn("Our previous run is still active, skipping this one.")
+    return
+
+  suppressions = util.SuppressionStore('track_relays_last_notified', default_duration = ONE_WEEK)
+
+  # Addresses and fingerprints are mapped to relays for constant time lookups.
+  # A relay is matched against every address it advertises, so one coming
+  # back on an IPv6 ORPort is caught as well.
 
-        tracked_address_ranges[stem.exit_policy.ExitPolicyRule('accept %s:*' % address)] = relay
-      else:
-        tracked_addresses[address] = relay
+  index = get_tracked_relay_index()
+  tracked_addresses = index.addresses
+  tracked_fingerprints = index.fingerprints
 
-    for fingerprint in relay.fingerprints:
-      tracked_fingerprints[fingerprint] = relay
+  found_relays = {}  # mapping of TrackedRelay => [(endpoint, RouterStatusEntry)]
 
-  found_relays = {}  # mapping of TrackedRelay => RouterStatusEntry
+  import stem.descriptor.remote  # deferred, it's costly to import
 
   for desc in stem.descriptor.remote.get_consensus():
-    if desc.address in tracked_addresses:
-      found_relays.setdefault(tracked_addresses[desc.address], []).append(desc)
-    elif desc.fingerprint in tracked_fingerprints:
-      found_relays.setdefault(tracked_fingerprints[desc.fingerprint], []).append(desc)
-    else:
-      for addr_entry, relay in tracked_address_ranges.items():
-        if addr_entry.is_match(desc.address):
-          found_relays.setdefault(relay, []).append(desc)
+    matches = {}  # mapping of TrackedRelay => endpoint it matched on
+
+    for address, port in _advertised_addresses(desc):
+      for relay in tracked_addresses.get(address):
+        matches.setdefault(relay, _endpoint_label(address, port))
+
+    if desc.fingerprint in tracked_fingerprints:
+      matches.setdefault(tracked_fingerprints[desc.fingerprint], _endpoint_label(desc.address, desc.or_port))
 
-  all_descriptors = []
+    for relay, endpoint in matches.items():
+      found_relays.setdefault(relay, []).append((endpoint, desc))
+
+  all_endpoints = []
 
   for relays in found_relays.values():
-    all_descriptors += relays
+    all_endpoints += [endpoint for endpoint, _ in relays]
 
-  if found_relays and not is_notification_suppressed(all_descriptors):
+  if found_relays and not is_notification_suppressed(suppressions, all_endpoints):
     log.debug("Sending a notification for %i relay entries..." % len(found_relays))
-    current_time = str(int(time.time()))
     body = EMAIL_BODY
 
     for tracked_relay, relays in found_relays.items():
       log.debug('* %s' % tracked_relay)
       body += '* %s (%s)\n' % (tracked_relay.identifier, tracked_relay.description)
 
-      for desc in relays:
-        body += '  address: %s:%s, fingerprint: %s\n' % (desc.address, desc.or_port, desc.fingerprint)
-        last_notified_config.set('%s:%s' % (desc.address, desc.or_port), current_time)
+      for endpoint, desc in relays:
+        body += '  address: %s, fingerprint: %s\n' % (endpoint, desc.fingerprint)
+        suppressions.mark(endpoint, ONE_WEEK)
 
     util.send(EMAIL_SUBJECT, body = body, to = ['bad-relays@lists.torproject.org', 'gk@torproject.org'])
-    last_notified_config.save()
+
+  suppressions.commit()
 
 
-def is_notification_suppressed(relays):
+def is_notification_suppressed(suppressions, endpoints):
   """
   Check to see if we've already notified for all these relays today. No
   point in causing too much noise.
+
+  :param util.SuppressionStore suppressions: when we last notified for relays
+  :param list endpoints: 'address:port' of the relays we'd notify for
   """
 
   is_all_suppressed = True
   log.debug("Checking if notification should be suppressed...")
-  last_notified_config = stem.util.conf.get_config('last_notified')
 
-  for desc in relays:
-    key = '%s:%s' % (desc.address, desc.or_port)
-    suppression_time = ONE_WEEK - (int(time.time()) - last_notified_config.get(key, 0))
+  for key in endpoints:
+    suppression_time = suppressions.remaining(key, ONE_WEEK)
 
     if suppression_time < 0:
       log.debug("* notification for %s isn't suppressed" % key)
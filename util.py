@@ -2,17 +2,22 @@
 Module for issuing email notifications to me via gmail.
 """
 
+import atexit
+import collections
+import errno
+import fcntl
 import getpass
 import logging
+import logging.handlers
 import os
+import queue
 import socket
-import smtplib
+import tempfile
+import threading
+import time
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
-import stem.util.connection
-import stem.util.log
+# Modules for emailing and talking with stem are imported where they're used,
+# so scripts that exit early don't pay for them at startup.
 
 FROM_ADDRESS = 'gk@torproject.org'
 TO_ADDRESSES = ['tor-consensus-health@lists.torproject.org']
@@ -20,6 +25,23 @@ ERROR_ADDRESS = 'gk@torproject.org'
 
 TEST_RUN = getpass.getuser() != 'doctor'  # print script results rather than emailing
 
+SUPPRESSION_RETENTION = 7 * 24 * 60 * 60  # how long we keep suppressions after they lapse
+LOCK_POLL_INTERVAL = 0.1  # seconds between attempts to acquire a held lock
+
+LOG_MAX_SIZE = 20 * 1024 * 1024  # bytes a log can grow to before it's rotated
+LOG_BACKUPS = 7  # rotated logs we keep
+STEM_DEBUG_BUFFER = 10000  # stem log records we keep in case our run fails
+
+LOG_FORMAT = logging.Formatter(
+  fmt = '%(asctime)s [%(levelname)s] %(message)s',
+  datefmt = '%m/%d/%Y %H:%M:%S',
+)
+
+_LOGGERS = {}  # {name => logger}, so each is only configured once
+_LOG_LISTENERS = []  # QueueListeners that write our logs
+_STEM_DEBUG = []  # (name, RingBufferHandler) for stem's output
+_RUN_LOCKS = {}  # {name => FileLock} held until our process exits
+
 
 def get_path(*comp):
   """
@@ -31,33 +53,391 @@ def get_path(*comp):
   return os.path.abspath(os.path.join(os.path.dirname(__file__), *comp))
 
 
+def atomic_write(path, content):
+  """
+  Writes a file by way of a temporary file that's then renamed into place, so
+  readers (or a crash partway through) never see a partially written file.
+
+  :param str path: file to write
+  :param str,bytes content: content of the file
+
+  :raises: **OSError** if unable to write the file
+  """
+
+  directory = os.path.dirname(path)
+
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+
+  if not isinstance(content, bytes):
+    content = content.encode('utf-8')
+
+  fd, tmp_path = tempfile.mkstemp(prefix = '.%s.' % os.path.basename(path), dir = directory)
+
+  try:
+    with os.fdopen(fd, 'wb') as tmp_file:
+      tmp_file.write(content)
+      tmp_file.flush()
+      os.fsync(tmp_file.fileno())
+
+    os.rename(tmp_path, path)
+  except:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+    raise
+
+
+class FileLock(object):
+  """
+  Advisory lock so our scripts can coordinate their use of shared files. This
+  is an flock on a separate lock file, so it doesn't interfere with reading or
+  replacing the files it guards, and is released by the OS if our process
+  dies. Locks are exclusive and not reentrant.
+
+  ::
+
+    with util.FileLock(util.get_path('data', 'archive', 'lock')):
+      ... read, modify, and write our files...
+
+  :var str path: location of our lock file
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._fd = None
+
+  def acquire(self, blocking = True, timeout = None):
+    """
+    Acquires our lock.
+
+    :param bool blocking: wait for the lock if another process holds it
+    :param float timeout: seconds we'll wait for the lock, no limit if **None**
+
+    :returns: **True** if we acquired the lock, **False** if another process
+      holds it and we either aren't blocking or timed out
+
+    :raises: **OSError** if unable to open our lock file
+    """
+
+    if self._fd is not None:
+      raise ValueError("We already hold the lock on '%s'" % self.path)
+
+    directory = os.path.dirname(self.path)
+
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+    deadline = time.time() + timeout if timeout is not None else None
+
+    while True:
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        break
+      except (IOError, OSError) as exc:
+        if exc.errno not in (errno.EAGAIN, errno.EACCES):
+          os.close(fd)
+          raise
+        elif not blocking or (deadline is not None and time.time() >= deadline):
+          os.close(fd)
+          return False
+
+        time.sleep(LOCK_POLL_INTERVAL)
+
+    # note our pid in the lock file to help with troubleshooting
+
+    os.ftruncate(fd, 0)
+    os.write(fd, ('%i\n' % os.getpid()).encode('utf-8'))
+
+    self._fd = fd
+    return True
+
+  def release(self):
+    """
+    Releases our lock if we hold it.
+    """
+
+    if self._fd is not None:
+      fcntl.flock(self._fd, fcntl.LOCK_UN)
+      os.close(self._fd)
+      self._fd = None
+
+  def holder(self):
+    """
+    Provides the process that most recently acquired this lock.
+
+    :returns: **int** pid of the process, **None** if unknown
+    """
+
+    try:
+      with open(self.path) as lock_file:
+        pid = lock_file.read().strip()
+
+      return int(pid) if pid.isdigit() else None
+    except IOError:
+      return None
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, exit_type, value, tb):
+    self.release()
+
+
+def acquire_run_lock(name):
+  """
+  Ensures only one run of a script is active at a time. Cron can start a
+  script before its prior run has finished, so scripts call this first and
+  exit if it fails, rather than stacking up behind a slow run.
+
+  The lock is held until our process exits.
+
+  :param str name: name of our script
+
+  :returns: **True** if we acquired the lock, **False** if a previous run
+    still holds it
+  """
+
+  if name in _RUN_LOCKS:
+    return True
+
+  lock = FileLock(get_path('data', '%s.lock' % name))
+
+  if not lock.acquire(blocking = False):
+    return False
+
+  _RUN_LOCKS[name] = lock
+  return True
+
+
+class SuppressionStore(object):
+  """
+  Record of when we last sent notifications, so we can avoid repeating
+  ourselves. Suppressions are kept in our state database under a name for
+  each script. They're read when we're constructed and changes are only
+  written when committed, so scripts running at the same time only overwrite
+  the keys they notified for.
+
+  Entries are pruned when their suppression lapsed long ago. Entries from
+  the older 'key timestamp' last_notified files lack a duration, so they're
+  kept for our default duration.
+
+  :var str name: name our suppressions are stored under
+  """
+
+  def __init__(self, name, default_duration = 0, store = None):
+    import state
+
+    self.name = name
+    self._store = store if store else state.get_store()
+    self._default_duration = default_duration
+    self._entries = self._store.suppressions(name)  # {key => (timestamp, duration)}
+    self._changed = {}  # entries we've marked since our last commit
+
+  def remaining(self, key, duration):
+    """
+    Provides how much longer notifications for a key are suppressed.
+
+    :param str key: key to check
+    :param int duration: seconds notifications are suppressed for
+
+    :returns: **int** for the seconds of suppression remaining, which is zero
+      or negative if we're not suppressed
+    """
+
+    timestamp, _ = self._entries.get(key, (0, 0))
+    return duration - (int(time.time()) - timestamp)
+
+  def mark(self, key, duration):
+    """
+    Records that we've notified for a key.
+
+    :param str key: key we're notifying for
+    :param int duration: seconds notifications will be suppressed for
+    """
+
+    self._entries[key] = self._changed[key] = (int(time.time()), duration)
+
+  def commit(self):
+    """
+    Persists the keys we've marked and prunes lapsed entries.
+
+    :raises: **sqlite3.Error** if unable to write to our state database
+    """
+
+    if self._changed:
+      self._store.set_suppressions(self.name, self._changed)
+      self._changed = {}
+
+    before = int(time.time()) - SUPPRESSION_RETENTION
+
+    if self._store.prune_suppressions(self.name, before, self._default_duration):
+      self._entries = self._store.suppressions(self.name)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+  """
+  Log file that's rotated when it grows too large, or on the first write of
+  a new day. Our scripts are short lived so the day is judged by when the log
+  was last written to.
+  """
+
+  def __init__(self, path):
+    logging.handlers.RotatingFileHandler.__init__(self, path, maxBytes = LOG_MAX_SIZE, backupCount = LOG_BACKUPS)
+    self._last_write_day = time.strftime('%Y-%m-%d', time.localtime(os.path.getmtime(path))) if os.path.exists(path) else None
+
+  def shouldRollover(self, record):
+    if self._last_write_day and self._last_write_day != time.strftime('%Y-%m-%d'):
+      return 1
+
+    return logging.handlers.RotatingFileHandler.shouldRollover(self, record)
+
+  def emit(self, record):
+    logging.handlers.RotatingFileHandler.emit(self, record)
+    self._last_write_day = time.strftime('%Y-%m-%d')
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+  """
+  Hands log records to a background thread for writing. Forked processes
+  lack that thread, so they write directly.
+  """
+
+  def __init__(self, log_queue, target):
+    logging.handlers.QueueHandler.__init__(self, log_queue)
+    self._target = target
+    self._pid = os.getpid()
+
+  def emit(self, record):
+    if os.getpid() != self._pid:
+      self._target.handle(record)
+    else:
+      logging.handlers.QueueHandler.emit(self, record)
+
+
+class RingBufferHandler(logging.Handler):
+  """
+  Keeps our most recent log records in memory. These are only formatted if
+  we write them out.
+  """
+
+  def __init__(self, capacity):
+    logging.Handler.__init__(self)
+    self.records = collections.deque(maxlen = capacity)
+
+  def emit(self, record):
+    self.records.append(record)
+
+  def write_to(self, path):
+    atomic_write(path, ''.join([LOG_FORMAT.format(record) + '\n' for record in list(self.records)]))
+    self.records.clear()
+
+
 def get_logger(name):
   """
-  Provides a logger configured to write to our local 'logs' directory.
+  Provides a logger configured to write to our local 'logs' directory. Logs
+  are written on a background thread, and rotated daily or when they grow
+  large. Repeated calls provide the same logger.
 
   :param str name: name of our log file
 
   :returns: preconfigured logger
   """
 
+  if name in _LOGGERS:
+    return _LOGGERS[name]
+
   log_dir = get_path('logs')
 
   if not os.path.exists(log_dir):
     os.mkdir(log_dir)
 
-  handler = logging.FileHandler(os.path.join(log_dir, name))
-  handler.setFormatter(logging.Formatter(
-    fmt = '%(asctime)s [%(levelname)s] %(message)s',
-    datefmt = '%m/%d/%Y %H:%M:%S',
-  ))
+  file_handler = RotatingFileHandler(os.path.join(log_dir, name))
+  file_handler.setFormatter(LOG_FORMAT)
+
+  log_queue = queue.Queue()
+  listener = logging.handlers.QueueListener(log_queue, file_handler)
+  listener.start()
+  _LOG_LISTENERS.append(listener)
 
   log = logging.getLogger(name)
   log.setLevel(logging.DEBUG)
-  log.addHandler(handler)
+  log.addHandler(QueueHandler(log_queue, file_handler))
 
+  _LOGGERS[name] = log
   return log
 
 
+@atexit.register
+def _stop_logging():
+  # writes anything still queued
+
+  while _LOG_LISTENERS:
+    _LOG_LISTENERS.pop().stop()
+
+
+def run_in_threads(tasks, max_workers = 8, timeout = None):
+  """
+  Runs callables concurrently on a bounded number of daemon threads. Tasks
+  that haven't finished by our timeout are abandoned, and as daemon threads
+  won't prevent the process from exiting.
+
+  :param list tasks: (key, callable) tuples for what to run
+  :param int max_workers: maximum number of tasks to run at once
+  :param float timeout: seconds to wait before giving up on unfinished tasks
+
+  :returns: **dict** mapping each finished task's key to a (result, exception)
+    tuple, where exception is **None** if the task succeeded
+  """
+
+  pending = list(reversed(tasks))
+  results = {}
+  finished = threading.Condition()
+  deadline = time.time() + timeout if timeout is not None else None
+
+  def worker():
+    while True:
+      with finished:
+        if not pending:
+          return
+
+        key, func = pending.pop()
+
+      try:
+        result = (func(), None)
+      except Exception as exc:
+        result = (None, exc)
+
+      with finished:
+        results[key] = result
+        finished.notify_all()
+
+  for _ in range(min(max_workers, len(tasks))):
+    thread = threading.Thread(target = worker)
+    thread.daemon = True
+    thread.start()
+
+  with finished:
+    while len(results) < len(tasks):
+      remaining = deadline - time.time() if deadline is not None else None
+
+      if remaining is not None and remaining <= 0:
+        del pending[:]  # don't start anything else
+        break
+
+      finished.wait(remaining)
+
+    return dict(results)
+
+
 def is_reachable(address, port):
   return check_reachability(address, port) == None
 
@@ -72,6 +452,8 @@ def check_reachability(address, port):
   :returns: **None** if the endpoint is reachable and a **str** describing the issue otherwise
   """
 
+  import stem.util.connection
+
   socket_type = socket.AF_INET6 if stem.util.connection.is_valid_ipv6_address(address) else socket.AF_INET
   test_socket = socket.socket(socket_type, socket.SOCK_STREAM)
 
@@ -86,24 +468,38 @@ def check_reachability(address, port):
 
 def log_stem_debugging(name):
   """
-  Logs trace level stem output to the given log file.
+  Keeps trace level stem output in memory, so it can be written to a log
+  file if our run fails. See flush_stem_debugging().
 
   :param str name: prefix name for our log file
   """
 
+  import stem.util.log
+
+  if name in [entry[0] for entry in _STEM_DEBUG]:
+    return
+
+  handler = RingBufferHandler(STEM_DEBUG_BUFFER)
+  stem.util.log.get_logger().addHandler(handler)
+  _STEM_DEBUG.append((name, handler))
+
+
+def flush_stem_debugging():
+  """
+  Writes the stem output we've kept to our 'logs' directory. This should be
+  called when a run fails.
+  """
+
   log_dir = get_path('logs')
 
   if not os.path.exists(log_dir):
     os.mkdir(log_dir)
 
-  handler = logging.FileHandler(os.path.join(log_dir, name + '.stem_debug'))
-  handler.setFormatter(logging.Formatter(
-    fmt = '%(asctime)s [%(levelname)s] %(message)s',
-    datefmt = '%m/%d/%Y %H:%M:%S',
-  ))
-
-  log = stem.util.log.get_logger()
-  log.addHandler(handler)
+  for name, handler in _STEM_DEBUG:
+    try:
+      handler.write_to(os.path.join(log_dir, name + '.stem_debug'))
+    except IOError:
+      pass  # logging our failure shouldn't mask it
 
 
 def send(subject, body, to = TO_ADDRESSES, cc = None, bcc = None):
@@ -126,6 +522,11 @@ def send(subject, body, to = TO_ADDRESSES, cc = None, bcc = None):
     print(body)
     return
 
+  import smtplib
+
+  from email.mime.multipart import MIMEMultipart
+  from email.mime.text import MIMEText
+
   msg = MIMEMultipart('alternative')
   msg['Subject'] = subject
   msg['From'] = FROM_ADDRESS